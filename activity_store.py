@@ -0,0 +1,186 @@
+r"""
+Local SQLite store of repository activity, synchronized incrementally from GitHub.
+
+Each repository and kind of record keeps a synchronization window: `low` is the earliest
+time the records are complete from, and `high` is the high-water mark (latest update seen).
+Subsequent syncs only need to fetch what changed after `high`. Deleted comments and
+removed stars are not detected.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+import sqlite3
+import threading
+
+Issue = namedtuple('Issue', 'number user state created_at updated_at closed_at comments '
+                            'pull_request')
+Comment = namedtuple('Comment', 'id issue_number user created_at updated_at')
+Star = namedtuple('Star', 'user starred_at')
+Fork = namedtuple('Fork', 'id owner created_at')
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS sync (repo TEXT, source TEXT, low TEXT, high TEXT,
+                                 PRIMARY KEY (repo, source));
+CREATE TABLE IF NOT EXISTS issues (repo TEXT, number INTEGER, login TEXT, state TEXT,
+                                   created_at TEXT, updated_at TEXT, closed_at TEXT,
+                                   comments INTEGER, is_pr INTEGER,
+                                   PRIMARY KEY (repo, number));
+CREATE INDEX IF NOT EXISTS issues_updated ON issues (repo, updated_at);
+CREATE TABLE IF NOT EXISTS comments (repo TEXT, id INTEGER, issue_number INTEGER, login TEXT,
+                                     created_at TEXT, updated_at TEXT,
+                                     PRIMARY KEY (repo, id));
+CREATE INDEX IF NOT EXISTS comments_updated ON comments (repo, updated_at);
+CREATE TABLE IF NOT EXISTS stars (repo TEXT, login TEXT, starred_at TEXT,
+                                  PRIMARY KEY (repo, login));
+CREATE INDEX IF NOT EXISTS stars_date ON stars (repo, starred_at);
+CREATE TABLE IF NOT EXISTS forks (repo TEXT, id INTEGER, login TEXT, created_at TEXT,
+                                  PRIMARY KEY (repo, id));
+CREATE INDEX IF NOT EXISTS forks_date ON forks (repo, created_at);
+'''
+
+_date_format = '%Y-%m-%d %H:%M:%S'
+
+
+def to_text(dt):
+    r"""
+    Convert a datetime to sortable text, in UTC.
+    """
+    if dt is None:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime(_date_format)
+
+
+def from_text(text):
+    return None if text is None else datetime.strptime(text, _date_format)
+
+
+def _login(user):
+    return user.login if user is not None else 'ghost'
+
+
+def _identity(login):
+    return login
+
+
+class ActivityStore(object):
+    def __init__(self, path):
+        # Connection is shared between worker threads, serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_schema)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _executemany(self, sql, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(sql, rows)
+
+    def get_sync(self, repo, source):
+        r"""
+        Get the synchronized window (low, high) for a kind of record, or (None, None).
+        """
+        rows = self._execute('SELECT low, high FROM sync WHERE repo=? AND source=?',
+                             (repo, source))
+        if not rows:
+            return None, None
+        return tuple(from_text(t) for t in rows[0])
+
+    def set_sync(self, repo, source, low, high):
+        self._executemany('INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?)',
+                          [(repo, source, to_text(low), to_text(high))])
+
+    def sync_updated(self, repo, source, start, fetch, store):
+        r"""
+        Bring records that can be listed by update time (``since=``) up to date.
+
+        `fetch(since)` returns the records updated since a time, and `store(records)` saves
+        them, returning the latest update time among them. Only if `start` is earlier than
+        what has been synchronized before is the full window since `start` fetched.
+        """
+        low, high = self.get_sync(repo, source)
+        if low is None or start < low:
+            low, since = start, start
+        else:
+            since = high
+        latest = store(fetch(since))
+        self.set_sync(repo, source, low, max(d for d in (latest, high, since) if d))
+
+    def sync_newest_first(self, repo, source, items, date_of, store):
+        r"""
+        Bring records listed newest first up to date, stopping at the high-water mark.
+        """
+        _, high = self.get_sync(repo, source)
+        high_text = to_text(high)
+        fresh = []
+        for item in items:
+            if high is not None and to_text(date_of(item)) < high_text:
+                break
+            fresh.append(item)
+        # Everything older than the mark was already stored by earlier syncs
+        self.set_sync(repo, source, None, store(fresh) or high)
+
+    def store_issues(self, repo, issues):
+        rows = [(repo, i.number, _login(i.user), i.state, to_text(i.created_at),
+                 to_text(i.updated_at), to_text(i.closed_at), i.comments,
+                 1 if i.pull_request else 0) for i in issues]
+        self._executemany('INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          rows)
+        return from_text(max((r[5] for r in rows), default=None))
+
+    def store_comments(self, repo, comments):
+        rows = [(repo, c.id, c.issue_number, _login(c.user),
+                 to_text(c.created_at), to_text(c.updated_at)) for c in comments]
+        self._executemany('INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return from_text(max((r[5] for r in rows), default=None))
+
+    def store_stars(self, repo, stars):
+        rows = [(repo, _login(s.user), to_text(s.starred_at)) for s in stars]
+        self._executemany('INSERT OR REPLACE INTO stars VALUES (?, ?, ?)', rows)
+        return from_text(max((r[2] for r in rows), default=None))
+
+    def store_forks(self, repo, forks):
+        rows = [(repo, f.id, _login(f.owner), to_text(f.created_at)) for f in forks]
+        self._executemany('INSERT OR REPLACE INTO forks VALUES (?, ?, ?, ?)', rows)
+        return from_text(max((r[3] for r in rows), default=None))
+
+    def issues(self, repo, start, end, make_user=_identity):
+        r"""
+        Get issues and PRs updated since `start` that were created, updated or closed in range.
+        """
+        start, end = to_text(start), to_text(end)
+        rows = self._execute(
+            'SELECT number, login, state, created_at, updated_at, closed_at, comments, is_pr '
+            'FROM issues WHERE repo=? AND updated_at >= ? AND ('
+            '(created_at BETWEEN ? AND ?) OR (updated_at BETWEEN ? AND ?) OR '
+            "(state='closed' AND closed_at BETWEEN ? AND ?)) ORDER BY number DESC",
+            (repo, start, start, end, start, end, start, end))
+        return [Issue(number, make_user(login), state, from_text(created), from_text(updated),
+                      from_text(closed), comments, bool(is_pr))
+                for number, login, state, created, updated, closed, comments, is_pr in rows]
+
+    def comments(self, repo, start, make_user=_identity):
+        r"""
+        Get issue and PR comments updated since `start`, oldest first.
+        """
+        rows = self._execute('SELECT id, issue_number, login, created_at, updated_at '
+                             'FROM comments WHERE repo=? AND updated_at >= ? '
+                             'ORDER BY created_at', (repo, to_text(start)))
+        return [Comment(cid, number, make_user(login), from_text(created), from_text(updated))
+                for cid, number, login, created, updated in rows]
+
+    def stars(self, repo, make_user=_identity):
+        rows = self._execute('SELECT login, starred_at FROM stars WHERE repo=? '
+                             'ORDER BY starred_at', (repo,))
+        return [Star(make_user(login), from_text(starred)) for login, starred in rows]
+
+    def forks(self, repo, make_user=_identity):
+        rows = self._execute('SELECT id, login, created_at FROM forks WHERE repo=? '
+                             'ORDER BY created_at', (repo,))
+        return [Fork(fid, make_user(login), from_text(created)) for fid, login, created in rows]
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+r"""
+Benchmark pulling the announcement out of release notes, on large synthetic changelogs.
+
+Compares `ReleaseNotes` from ``release_notes/render_template.py`` with the regular
+expressions it replaced, which backtrack heavily as the changelog grows, so those are only
+run up to ``--baseline-max`` entries.
+"""
+import os
+import random
+import re
+import sys
+import time
+
+from fake_github import synthetic_release_notes
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'release_notes'))
+from render_template import ReleaseNotes  # noqa: E402
+
+
+def regex_announcement(body, plain=False):
+    r"""
+    Get the announcement text the way render_template.py used to.
+    """
+    def sub_header(match):
+        s = match.group(1).strip()
+        return s + '\n' + '-' * len(s)
+
+    find_api_changes = re.compile(r'.*(?:API Changes)(.*?)[# ]*(?:Highlights|Summary)',
+                                  re.MULTILINE | re.DOTALL)
+    api_changes = find_api_changes.findall(body)
+    api_changes = api_changes[0].strip() if api_changes else ''
+    find_notes = re.compile(r'.*(?:Highlights|Summary)(.*?)[# ]*'
+                            r'(?:Issues|New Features|Enhancements|Bugs Fixed)',
+                            re.MULTILINE | re.DOTALL)
+    notes = find_notes.findall(body)[0].strip()
+    header_replace = re.compile(r'#+ (.+)')
+    text = (header_replace.sub(sub_header, api_changes).replace('\r\n', '\n') + '\n' +
+            header_replace.sub(sub_header, notes).replace('\r\n', '\n'))
+    if plain:
+        links = re.findall(r'\[.*\]\(.*\)', text)
+        for link in links:
+            text = text.replace(link, link.replace('[', '').replace(']', ' '))
+    return text
+
+
+def section_announcement(body, plain=False):
+    return ReleaseNotes(body).announcement(plain)
+
+
+def best_time(func, body, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(body, plain=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-e', '--entries', help='Pull request entries per section to try',
+                        type=int, nargs='+', default=[50, 100, 1000, 5000])
+    parser.add_argument('--baseline-max', help='Largest number of entries to time the regular '
+                        'expressions on', type=int, default=100)
+    parser.add_argument('-r', '--repeat', help='Times to run each, keeping the best', type=int,
+                        default=3)
+    args = parser.parse_args()
+
+    print('{0:>8} {1:>10} {2:>12} {3:>12}'.format('Entries', 'Size [kB]', 'Regex [ms]',
+                                                   'Single [ms]'))
+    for entries in args.entries:
+        body = synthetic_release_notes(random.Random(entries), entries)
+        regex = '-'
+        if entries <= args.baseline_max:
+            regex = '{0:.1f}'.format(1000 * best_time(regex_announcement, body, args.repeat))
+        single = 1000 * best_time(section_announcement, body, args.repeat)
+        print('{0:>8} {1:>10.0f} {2:>12} {3:>12.1f}'.format(entries, len(body) / 1024, regex,
+                                                             single))
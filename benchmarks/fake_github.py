@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+r"""
+Local stand-in for the GitHub REST (and a little GraphQL) API, serving fixtures.
+
+Fixtures map a request path to its JSON payload. List payloads are paginated with ``Link``
+headers the way GitHub does, and filtered for the query parameters used by the scripts in
+this repository. Every response carries ETag and rate limit headers, and an artificial
+latency can be added to each request. Fixtures are either generated (`synthetic_fixtures`)
+or recorded to a JSON file, in which ``{base}`` stands for the server's URL.
+"""
+from datetime import datetime, timedelta
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+_date_format = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _iso(dt):
+    return dt.strftime(_date_format)
+
+
+def synthetic_fixtures(base, org='Unidata', repos=None, members=25, seed=0):
+    r"""
+    Generate fixtures for an organization.
+
+    `repos` maps repository names to dicts with the number of ``issues``, ``comments``,
+    ``stars``, ``forks``, ``watchers``, ``commits``, ``labels`` and ``releases`` to
+    make, spread over the last two years.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    fixtures = dict()
+    users = dict()
+
+    def user(login):
+        if login not in users:
+            users[login] = dict(login=login, id=len(users) + 1, type='User',
+                                url='{0}/users/{1}'.format(base, quote(login)),
+                                name=login.title(), email='{0}@example.edu'.format(login),
+                                company=rng.choice(['University of Somewhere', 'NOAA', 'ACME',
+                                                    None]))
+        return dict(login=login, id=users[login]['id'], url=users[login]['url'])
+
+    def when(days=730):
+        return now - timedelta(seconds=rng.randrange(days * 86400))
+
+    member_logins = ['member{0}'.format(i) for i in range(members)]
+    fixtures['/orgs/{0}'.format(org)] = dict(login=org, id=1, url='{0}/orgs/{1}'.format(base, org))
+    fixtures['/orgs/{0}/members'.format(org)] = [user(m) for m in member_logins]
+
+    def participant():
+        # Mostly outside users, with some activity from members
+        if rng.random() < 0.3:
+            return user(rng.choice(member_logins))
+        return user('user{0}'.format(rng.randrange(5000)))
+
+    org_repos = []
+    for repo_id, (name, sizes) in enumerate(sorted((repos or dict()).items()), start=1):
+        path = '/repos/{0}/{1}'.format(org, name)
+        url = base + path
+        created = now - timedelta(days=3650)
+        repo = dict(id=repo_id, name=name, full_name='{0}/{1}'.format(org, name),
+                    owner=dict(login=org, url='{0}/users/{1}'.format(base, org)), url=url,
+                    created_at=_iso(created), stargazers_count=sizes.get('stars', 0),
+                    forks_count=sizes.get('forks', 0), watchers_count=sizes.get('stars', 0),
+                    subscribers_count=sizes.get('watchers', 0))
+        fixtures[path] = repo
+        org_repos.append(repo)
+
+        issues = []
+        for number in range(1, sizes.get('issues', 0) + 1):
+            created_at = when()
+            updated_at = created_at + timedelta(seconds=rng.randrange(
+                max(int((now - created_at).total_seconds()), 1)))
+            closed = rng.random() < 0.7
+            issue = dict(id=repo_id * 1000000 + number, number=number, title='Issue {0}'.format(number),
+                         state='closed' if closed else 'open', user=participant(),
+                         created_at=_iso(created_at), updated_at=_iso(updated_at),
+                         closed_at=_iso(updated_at) if closed else None, comments=0,
+                         url='{0}/issues/{1}'.format(url, number))
+            if rng.random() < 0.4:
+                issue['pull_request'] = dict(url='{0}/pulls/{1}'.format(url, number))
+            issues.append(issue)
+        fixtures[path + '/issues'] = issues
+
+        comments = []
+        for comment_id in range(1, sizes.get('comments', 0) + 1):
+            issue = rng.choice(issues)
+            created_at = datetime.strptime(issue['created_at'], _date_format)
+            created_at += timedelta(seconds=rng.randrange(
+                max(int((now - created_at).total_seconds()), 1)))
+            issue['comments'] += 1
+            if issue['updated_at'] < _iso(created_at):
+                issue['updated_at'] = _iso(created_at)
+            comments.append(dict(id=repo_id * 1000000 + comment_id, user=participant(),
+                                 created_at=_iso(created_at), updated_at=_iso(created_at),
+                                 issue_url=issue['url'], body='Comment {0}'.format(comment_id),
+                                 url='{0}/issues/comments/{1}'.format(url, comment_id)))
+        fixtures[path + '/issues/comments'] = sorted(comments, key=lambda c: c['created_at'])
+
+        fixtures[path + '/stargazers'] = sorted(
+            (dict(starred_at=_iso(when(3650)), user=user('user{0}'.format(i)))
+             for i in range(sizes.get('stars', 0))), key=lambda s: s['starred_at'])
+
+        forks = []
+        for i in range(sizes.get('forks', 0)):
+            owner = participant()
+            forks.append(dict(id=repo_id * 1000000 + i, name=name,
+                              full_name='{0}/{1}'.format(owner['login'], name), owner=owner,
+                              created_at=_iso(when(3650)),
+                              url='{0}/repos/{1}/{2}'.format(base, owner['login'], name)))
+        fixtures[path + '/forks'] = forks
+
+        fixtures[path + '/subscribers'] = [participant() for _ in range(sizes.get('watchers', 0))]
+
+        fixtures[path + '/commits'] = [
+            dict(sha=hashlib.sha1(str(i).encode()).hexdigest(),
+                 url='{0}/commits/{1}'.format(url, i),
+                 commit=dict(author=dict(name='Someone', date=_iso(when()))))
+            for i in range(sizes.get('commits', 0))]
+
+        fixtures[path + '/labels'] = [
+            dict(name='Label {0}'.format(i), color='{0:06x}'.format(rng.randrange(0x1000000)),
+                 description=None, url='{0}/labels/Label%20{1}'.format(url, i))
+            for i in range(sizes.get('labels', 0))]
+
+        fixtures[path + '/releases'] = [
+            dict(id=i, tag_name='v1.{0}.0'.format(i), name='{0} 1.{1}.0'.format(name, i),
+                 body=synthetic_release_notes(rng, 50), url='{0}/releases/{1}'.format(url, i),
+                 created_at=_iso(now - timedelta(days=30 * i)), draft=False, prerelease=False)
+            for i in range(sizes.get('releases', 0))]
+
+    fixtures['/orgs/{0}/repos'.format(org)] = org_repos
+    for login, info in users.items():
+        fixtures['/users/' + login] = info
+    return fixtures
+
+
+def synthetic_release_notes(rng, entries):
+    r"""
+    Generate a GitHub-style markdown changelog with `entries` pull request lines per section.
+    """
+    lines = ['## Highlights', '* Something [important](https://example.com/docs) changed', '',
+             '## API Changes', '* `old_function` was [removed](https://example.com/pr/1)', '']
+    for section in ('Issues Closed', 'Pull Requests Merged'):
+        lines.append('### {0}'.format(section))
+        for i in range(entries):
+            number = rng.randrange(100000)
+            lines.append('* [PR {0}](https://github.com/Unidata/MetPy/pull/{0}) - Fix '
+                         'thing [#{1}](https://github.com/Unidata/MetPy/issues/{1})'.format(
+                             number, i))
+        lines.append('')
+    lines.extend(['## Summary', 'Thanks to all contributors.', ''])
+    return '\r\n'.join(lines)
+
+
+def load_fixtures(path, base):
+    with open(path, 'rt') as infile:
+        return json.loads(infile.read().replace('{base}', base))
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _query(self):
+        parts = urlsplit(self.path)
+        return unquote(parts.path), {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+    def _send(self, status, payload=None, headers=None):
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for key, value in self.server.rate_limit_headers().items():
+            self.send_header(key, value)
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send(404, dict(message='Not Found'))
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def do_GET(self):
+        self.server.count_request(self.command, self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path, params = self._query()
+        payload = self.server.lookup(path, params, self.headers.get('Accept', ''))
+        if payload is None:
+            return self._not_found()
+
+        headers = dict()
+        if path == '/search/issues':
+            items, headers = self._paginate(path, params, payload)
+            payload = dict(total_count=len(payload), incomplete_results=False, items=items)
+        elif isinstance(payload, list):
+            payload, headers = self._paginate(path, params, payload)
+
+        etag = '"{0}"'.format(hashlib.sha1(json.dumps(payload).encode('utf-8')).hexdigest())
+        headers['ETag'] = etag
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count_not_modified()
+            headers.pop('Link', None)
+            return self._send(304, None, headers)
+        self._send(200, payload, headers)
+
+    def _paginate(self, path, params, items):
+        per_page = min(int(params.get('per_page', 30)), 100)
+        page = int(params.get('page', 1))
+        last = max(1, -(-len(items) // per_page))
+
+        def link(n):
+            query = dict(params, page=n)
+            return '<{0}{1}?{2}>'.format(self.server.base_url, quote(path), urlencode(query))
+
+        rels = []
+        if page < last:
+            rels.extend(['{0}; rel="next"'.format(link(page + 1)),
+                         '{0}; rel="last"'.format(link(last))])
+        if page > 1:
+            rels.extend(['{0}; rel="first"'.format(link(1)),
+                         '{0}; rel="prev"'.format(link(page - 1))])
+        headers = {'Link': ', '.join(rels)} if rels else dict()
+        return items[(page - 1) * per_page:page * per_page], headers
+
+    def do_POST(self):
+        self.server.count_request(self.command, self.path)
+        path, _ = self._query()
+        data = self._read_json()
+        if path == '/graphql':
+            return self._send(200, self.server.graphql(data['query']))
+        match = re.match(r'^(/repos/[^/]+/[^/]+/labels)$', path)
+        if match:
+            label = dict(name=data['name'], color=data['color'],
+                         description=data.get('description'),
+                         url='{0}{1}/{2}'.format(self.server.base_url, path, quote(data['name'])))
+            self.server.fixtures.setdefault(path, []).append(label)
+            return self._send(201, label)
+        self._not_found()
+
+    def do_PATCH(self):
+        self.server.count_request(self.command, self.path)
+        path, _ = self._query()
+        data = self._read_json()
+        label = self.server.lookup(path, dict(), '')
+        if label is None:
+            return self._not_found()
+        if 'new_name' in data:
+            data['name'] = data.pop('new_name')
+        label.update(data)
+        label['url'] = '{0}{1}/{2}'.format(self.server.base_url, path.rsplit('/', 1)[0],
+                                            quote(label['name']))
+        self._send(200, label)
+
+    def do_DELETE(self):
+        self.server.count_request(self.command, self.path)
+        path, _ = self._query()
+        collection, _, name = path.rpartition('/')
+        labels = self.server.fixtures.get(collection, [])
+        remaining = [label for label in labels if label['name'] != name]
+        if len(remaining) == len(labels):
+            return self._not_found()
+        self.server.fixtures[collection] = remaining
+        self._send(204)
+
+
+class FakeGitHub(ThreadingHTTPServer):
+    r"""
+    Serve fixtures on localhost, counting the requests made.
+
+    Create with fixtures generated for (or loaded with) `base_url`, and run `start()`.
+    Requests are allowed `rate_limit` at a time each hour, as reported in the rate limit
+    headers; resetting the counts starts a fresh budget.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, rate_limit=5000):
+        super(FakeGitHub, self).__init__(('127.0.0.1', port), FakeGitHubHandler)
+        self.base_url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        self.latency = latency
+        self.fixtures = dict()
+        self.requests = dict()
+        self.not_modified = 0
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._used = 0
+        self._reset = int(time.time()) + 3600
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = dict()
+            self.not_modified = 0
+            self._used = 0
+
+    def count_request(self, verb, path):
+        # Group by the kind of request, without query and identifiers
+        kind = '{0} {1}'.format(verb, re.sub(r'/(\d+|user\d+|member\d+)(?=/|$)', '/:id',
+                                             urlsplit(path).path))
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self._used += 1
+
+    def count_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+            self._used -= 1
+
+    def rate_limit_headers(self):
+        with self._lock:
+            if time.time() >= self._reset:
+                self._used = 0
+                self._reset = int(time.time()) + 3600
+            remaining = max(self.rate_limit - self._used, 0)
+        return {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(self._reset), 'X-RateLimit-Resource': 'core'}
+
+    def lookup(self, path, params, accept):
+        r"""
+        Find the payload for a GET request, applying filters and ordering for listings.
+        """
+        if path == '/rate_limit':
+            core = dict(limit=self.rate_limit, remaining=int(self.rate_limit_headers()[
+                'X-RateLimit-Remaining']), reset=self._reset, used=0)
+            return dict(resources=dict(core=core, search=core, graphql=core), rate=core)
+
+        if path == '/search/issues':
+            return self.search_issues(params.get('q', ''))
+
+        if path in self.fixtures:
+            payload = self.fixtures[path]
+            if isinstance(payload, list):
+                payload = self._filter(path, params, accept, payload)
+            return payload
+
+        match = re.match(r'^(/repos/[^/]+/[^/]+/issues)/(\d+)/comments$', path)
+        if match:
+            issue_url = '{0}{1}/{2}'.format(self.base_url, match.group(1), match.group(2))
+            return [c for c in self.fixtures.get(match.group(1) + '/comments', [])
+                    if c['issue_url'] == issue_url]
+
+        match = re.match(r'^(/repos/[^/]+/[^/]+)/releases/(latest|tags/(.+))$', path)
+        if match:
+            releases = self.fixtures.get(match.group(1) + '/releases') or [None]
+            if match.group(2) == 'latest':
+                return releases[0]
+            return next((r for r in releases if r and r['tag_name'] == match.group(3)), None)
+
+        # Single items of a listing, such as when PyGithub completes an issue
+        collection, _, key = path.rpartition('/')
+        for item in self.fixtures.get(collection) or []:
+            if key.lower() in (str(item.get('number')), str(item.get('id')),
+                               str(item.get('name', '')).lower()):
+                return item
+        return None
+
+    def search_issues(self, query):
+        r"""
+        Find the issues matching a search query, supporting the qualifiers the scripts use:
+        ``repo:``, ``is:issue``/``is:pr``, ``created:``/``closed:`` ranges and ``-author:``.
+        """
+        items = []
+        excluded = set()
+        checks = []
+        for term in query.split():
+            qualifier, _, value = term.partition(':')
+            if qualifier == 'repo':
+                items = self.fixtures.get('/repos/{0}/issues'.format(value), [])
+            elif qualifier == 'is':
+                checks.append(lambda i, pr=value == 'pr': bool(i.get('pull_request')) == pr)
+            elif qualifier in ('created', 'closed'):
+                low, _, high = value.partition('..')
+                checks.append(lambda i, field=qualifier + '_at', low=low, high=high:
+                              i[field] is not None and low <= i[field] <= high)
+            elif qualifier == '-author':
+                excluded.add(value.lower())
+        return [i for i in items if i['user']['login'].lower() not in excluded and
+                all(check(i) for check in checks)]
+
+    @staticmethod
+    def _filter(path, params, accept, items):
+        if path.endswith('/issues/comments'):
+            if 'since' in params:
+                items = [c for c in items if c['updated_at'] >= params['since']]
+        elif path.endswith('/issues'):
+            state = params.get('state', 'open')
+            if state != 'all':
+                items = [i for i in items if i['state'] == state]
+            if 'since' in params:
+                items = [i for i in items if i['updated_at'] >= params['since']]
+            items = sorted(items, key=lambda i: i['created_at'],
+                           reverse=params.get('direction', 'desc') == 'desc')
+        elif path.endswith('/stargazers'):
+            if 'star+json' not in accept:
+                items = [s['user'] for s in items]
+        elif path.endswith('/forks'):
+            items = sorted(items, key=lambda f: f['created_at'],
+                           reverse=params.get('sort', 'newest') == 'newest')
+        elif path.endswith('/commits'):
+            items = [c for c in items
+                     if params.get('since', '') <= c['commit']['author']['date'] <=
+                     params.get('until', '9999')]
+        return items
+
+    def graphql(self, query):
+        r"""
+        Answer aliased ``repositoryOwner(login:)`` lookups, the only GraphQL used here.
+        """
+        data = dict()
+        errors = []
+        for alias, login in re.findall(r'(\w+): repositoryOwner\(login: "((?:[^"\\]|\\.)*)"\)',
+                                       query):
+            user = self.fixtures.get('/users/' + json.loads('"{0}"'.format(login)))
+            if user is None:
+                data[alias] = None
+                errors.append(dict(type='NOT_FOUND', path=[alias]))
+            else:
+                data[alias] = dict(name=user['name'], email=user['email'] or '')
+                if user.get('type') != 'Organization':
+                    data[alias]['company'] = user['company']
+        result = dict(data=data)
+        if errors:
+            result['errors'] = errors
+        return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8765)
+    parser.add_argument('-l', '--latency', help='Added latency per request [s]', type=float,
+                        default=0)
+    parser.add_argument('-r', '--rate-limit', help='Requests allowed each hour', type=int,
+                        default=5000)
+    parser.add_argument('-f', '--fixtures', help='JSON file of recorded fixtures', type=str)
+    parser.add_argument('--repos', help='Number of synthetic repositories', type=int, default=3)
+    args = parser.parse_args()
+
+    server = FakeGitHub(args.port, args.latency, args.rate_limit)
+    if args.fixtures:
+        server.fixtures = load_fixtures(args.fixtures, server.base_url)
+    else:
+        server.fixtures = synthetic_fixtures(
+            server.base_url, repos={'repo{0}'.format(i): dict(
+                issues=200, comments=600, stars=500, forks=100, watchers=40, commits=300,
+                labels=20, releases=3) for i in range(args.repos)})
+    print('Serving fake GitHub API at {0} (set GITHUB_API_URL)'.format(server.base_url))
+    server.serve_forever()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+r"""
+Offline benchmarks of the scripts in this repository, run against `fake_github`.
+
+Each scenario runs a script in a subprocess pointed at the fake API (via GITHUB_API_URL)
+and reports wall time, the number of API requests made and the peak memory used.
+"""
+from collections import namedtuple
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_github import FakeGitHub, synthetic_fixtures
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+Scenario = namedtuple('Scenario', 'name script args')
+Result = namedtuple('Result', 'name seconds requests not_modified peak_mb')
+
+typical_repo = dict(issues=150, comments=450, stars=300, forks=60, watchers=40, commits=500,
+                    labels=25, releases=3)
+many_repos = ['repo{0}'.format(i) for i in range(15)]
+
+
+def make_fixtures(base):
+    repos = {name: typical_repo for name in many_repos}
+    repos['bigrepo'] = dict(issues=1500, comments=4000, stars=5000, forks=800, watchers=200,
+                            commits=2000, labels=30, releases=10)
+    return synthetic_fixtures(base, repos=repos)
+
+
+def scenarios(workdir):
+    cache_dir = os.path.join(workdir, 'cache')
+    labels = os.path.join(workdir, 'labels.txt')
+
+    def own_cache(name):
+        # Each scenario gets a cache of its own, out of the user's home directory
+        return ['--cache-dir', os.path.join(workdir, 'cache-' + name)]
+
+    return [
+        Scenario('15 repos, 90 days', 'github-stats.py',
+                 ['-d', '90', '--no-cache'] + many_repos),
+        Scenario('15 repos, 90 days, cold cache', 'github-stats.py',
+                 ['-d', '90', '--cache-dir', cache_dir] + many_repos),
+        Scenario('15 repos, 90 days, warm cache', 'github-stats.py',
+                 ['-d', '90', '--cache-dir', cache_dir] + many_repos),
+        Scenario('15 repos, 90 days, nsf format', 'github-stats.py',
+                 ['-d', '90', '--no-cache', '-f', 'nsf'] + many_repos),
+        Scenario('15 repos, 90 days, summary format', 'github-stats.py',
+                 ['-d', '90', '--no-cache', '-f', 'summary'] + many_repos),
+        Scenario('15 repos, 12 monthly buckets', 'github-stats.py',
+                 ['-d', '365', '--no-cache', '--bucket', 'month'] + many_repos),
+        Scenario('15 repos, 90 days, event export', 'github-stats.py',
+                 ['-d', '90', '--no-cache', '--export', os.path.join(workdir, 'events.csv')] +
+                 many_repos),
+        Scenario('5k-star repo, verbose=2', 'github-stats.py',
+                 ['-d', '90', '--no-cache', '-v', '-v', 'bigrepo']),
+        Scenario('15 repos, 90 days, plan', 'github-stats.py',
+                 ['-d', '90', '--no-cache', '--plan'] + many_repos),
+        Scenario('labels get', 'github-labels.py',
+                 ['bigrepo', 'get', '-f', labels] + own_cache('labels-get')),
+        Scenario('labels update', 'github-labels.py',
+                 ['repo0', 'update', '-f', labels] + own_cache('labels-update')),
+        Scenario('release notes', os.path.join('release_notes', 'render_template.py'),
+                 ['bigrepo'] + own_cache('release')),
+        Scenario('release notes, batch of 25', os.path.join('release_notes',
+                                                            'render_template.py'),
+                 ['bigrepo@..'] + many_repos + own_cache('release-batch')),
+    ]
+
+
+def run(server, scenario, workdir, verbose=False):
+    r"""
+    Run one scenario, returning its `Result`.
+    """
+    env = dict(os.environ, GITHUB_API_URL=server.base_url, GITHUB_TOKEN='benchmark')
+    command = [sys.executable, os.path.join(root, scenario.script)] + scenario.args
+    server.reset_counts()
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=workdir, env=env, stdout=output,
+                                stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        output.seek(0)
+        text = output.read().decode('utf-8', 'replace')
+    if proc.returncode:
+        raise RuntimeError('{0} failed:\n{1}'.format(scenario.name, text))
+    if verbose:
+        print(text)
+
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return Result(scenario.name, elapsed, server.request_count, server.not_modified, peak)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-k', '--select', help='Only run scenarios containing this text',
+                        type=str, default='')
+    parser.add_argument('-l', '--latency', help='Added latency per request [s]', type=float,
+                        default=0.02)
+    parser.add_argument('-o', '--output', help='File to write results to, as JSON lines',
+                        type=str)
+    parser.add_argument('-v', '--verbose', help='Print the output of the scripts',
+                        action='store_true')
+    args = parser.parse_args()
+
+    server = FakeGitHub(latency=args.latency).start()
+    server.fixtures = make_fixtures(server.base_url)
+
+    workdir = tempfile.mkdtemp(prefix='github-utils-bench-')
+    try:
+        # render_template.py writes next to its templates, so give it a copy to work in
+        shutil.copytree(os.path.join(root, 'release_notes', 'templates'),
+                        os.path.join(workdir, 'templates'))
+        os.mkdir(os.path.join(workdir, 'formatted_notes'))
+
+        results = []
+        print('{0:<35} {1:>9} {2:>9} {3:>9} {4:>9}'.format('Scenario', 'Time [s]', 'Requests',
+                                                            '304s', 'Peak [MB]'))
+        for scenario in scenarios(workdir):
+            if args.select not in scenario.name:
+                continue
+            result = run(server, scenario, workdir, args.verbose)
+            results.append(result)
+            print('{0.name:<35} {0.seconds:9.2f} {0.requests:9d} {0.not_modified:9d} '
+                  '{0.peak_mb:9.1f}'.format(result))
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'wt') as outfile:
+            for result in results:
+                outfile.write(json.dumps(dict(result._asdict(), latency=args.latency)) + '\n')
@@ -3,19 +3,149 @@
 # Distributed under the terms of the BSD 3-Clause License.
 # SPDX-License-Identifier: BSD-3-Clause
 
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+
 import github
 
+from github_client import add_arguments, Client
+from pagination import PrefetchedList
+
+LabelChange = namedtuple('LabelChange', 'action name new_name color url')
+
+# Past and future tense of each change, and what it is made to
+_change_text = dict(create=('Created', 'create', '{0.new_name} (#{0.color})'),
+                    rename=('Updated', 'update', '{0.name}->{0.new_name} (#{0.color})'),
+                    recolor=('Recolored', 'recolor', '{0.name} (#{0.color})'),
+                    delete=('Deleted', 'delete', '{0.name}'))
+
+
+def read_labels(path):
+    r"""
+    Read the wanted labels from a file, as (old name, new name, color).
+
+    Each line is either ``name|color`` or ``old name|new name|color``.
+    """
+    labels = []
+    with open(path, 'rt') as infile:
+        for line in infile:
+            parts = line.strip().split('|')
+            if len(parts) == 3:
+                labels.append(tuple(parts))
+            elif len(parts) == 2:
+                labels.append((parts[0],) + tuple(parts))
+    return labels
+
+
+def get_labels(repo):
+    r"""
+    Get the labels of a repository as JSON, keyed by their lowercased name.
+    """
+    return {label['name'].lower(): label
+            for label in PrefetchedList(repo._requester, repo.url + '/labels')}
+
+
+def plan_changes(existing, wanted, delete=False):
+    r"""
+    Work out the `LabelChange` needed to bring each label in line with the labels file.
+
+    `existing` are the current labels from `get_labels` and `wanted` those from
+    `read_labels`. Label names on GitHub are not case-sensitive, so a label that only
+    differs in case is renamed. A rename whose new name already exists (as when re-run) is
+    treated as an update of that label. With `delete`, labels not in the file are deleted.
+    """
+    changes = []
+    kept = set()
+    for old_name, new_name, color in wanted:
+        label = existing.get(new_name.lower()) or existing.get(old_name.lower())
+        if label is None:
+            changes.append(LabelChange('create', new_name, new_name, color, None))
+            continue
+
+        kept.add(label['name'].lower())
+        if label['name'] != new_name:
+            action = 'rename'
+        elif label['color'].lower() != color.lower():
+            action = 'recolor'
+        else:
+            action = 'unchanged'
+        changes.append(LabelChange(action, label['name'], new_name, color, label['url']))
+
+    if delete:
+        changes.extend(LabelChange('delete', label['name'], None, label['color'], label['url'])
+                       for key, label in sorted(existing.items()) if key not in kept)
+    return changes
+
 
-def get_token():
+def apply_change(repo, change):
     r"""
-    Get the API token to use for talking to GitHub
+    Make the API call for a `LabelChange`, if it needs one.
     """
-    try:
-        with open('token', 'rt') as token_file:
-            return token_file.readline()[:-1]
-    except IOError:
-        import os
-        return os.environ['GITHUB_TOKEN']
+    requester = repo._requester
+    if change.action == 'create':
+        requester.requestJsonAndCheck('POST', repo.url + '/labels',
+                                      input=dict(name=change.new_name, color=change.color))
+    elif change.action in ('rename', 'recolor'):
+        requester.requestJsonAndCheck('PATCH', change.url,
+                                      input=dict(new_name=change.new_name, color=change.color))
+    elif change.action == 'delete':
+        requester.requestJsonAndCheck('DELETE', change.url)
+
+
+def sync_labels(repo, wanted, delete=False, dry_run=False):
+    r"""
+    Bring the labels of a repository in line with `wanted`, from `read_labels`.
+
+    Returns the planned changes, and the (change, error) of those that failed; a failure
+    does not stop the other changes being made.
+    """
+    changes = plan_changes(get_labels(repo), wanted, delete)
+    failures = []
+    if not dry_run:
+        for change in changes:
+            try:
+                apply_change(repo, change)
+            except github.GithubException as e:
+                failures.append((change, e))
+    return changes, failures
+
+
+def resolve_repos(g, org_name, patterns):
+    r"""
+    Get the names of the repositories in an organization matching any of `patterns`.
+
+    Patterns without wildcards are taken as names as they are, so the organization's
+    repositories are only listed if needed. Wildcards do not match archived repositories,
+    which are read-only.
+    """
+    names = None
+    resolved = []
+    for pattern in patterns:
+        if not set('*?[') & set(pattern):
+            matches = [pattern]
+        else:
+            if names is None:
+                org = g.get_organization(org_name)
+                names = sorted((r['name'] for r in PrefetchedList(org._requester,
+                                                                  org.url + '/repos')
+                                if not r.get('archived')), key=str.lower)
+            matches = [name for name in names if fnmatchcase(name.lower(), pattern.lower())]
+        resolved.extend(name for name in matches if name not in resolved)
+    return resolved
+
+
+def describe_change(change, dry_run=False):
+    done, planned, detail = _change_text[change.action]
+    verb = 'Would ' + planned if dry_run else done
+    return '{0} label: {1}'.format(verb, detail.format(change))
+
+
+def summarize_changes(changes):
+    counts = Counter(c.action for c in changes)
+    return ', '.join('{0} {1}'.format(counts[action], past) for action, past in
+                     (('create', 'created'), ('rename', 'renamed'), ('recolor', 'recolored'),
+                      ('delete', 'deleted'), ('unchanged', 'unchanged')))
 
 
 if __name__ == '__main__':
@@ -23,47 +153,76 @@ if __name__ == '__main__':
 
     # Get command-line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('repository', help='Repository', type=str)
+    parser.add_argument('repository', help='Repository, or for update, a comma-separated list '
+                        'of them, which can use wildcards (* for all in the organization); '
+                        'wildcards skip archived repositories',
+                        type=str)
     parser.add_argument('-o', '--org', help='Organization', type=str, default='Unidata')
     parser.add_argument('action', help='Action to take', type=str, choices=['get', 'update'],
                         default='get', nargs='?')
     parser.add_argument('-f', '--filename', help='File for storing labels', type=str,
                         default='labels.txt')
+    parser.add_argument('--delete', help='When updating, delete labels not in the file',
+                        action='store_true')
+    parser.add_argument('-n', '--dry-run', help='Print the changes an update would make, '
+                        'without making them', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of repositories to update concurrently',
+                        type=int, default=8)
+    add_arguments(parser)
     args = parser.parse_args()
 
     # Get the github API entry
-    token = get_token()
-    g = github.Github(token)
-
-    # Get the organization
-    org = g.get_organization(args.org)
-
-    # Get the object for this repository
-    repo = org.get_repo(args.repository)
+    client = Client.from_args(args)
+    g = client.github()
 
     #
     if args.action == 'get':
+        # Get the object for this repository
+        repo = g.get_repo('{0}/{1}'.format(args.org, args.repository))
         print('Getting labels from {0}'.format(args.repository))
         with open(args.filename, 'wt') as outfile:
-            labels = sorted((l.name, l.color) for l in repo.get_labels())
+            labels = sorted((l['name'], l['color']) for l in get_labels(repo).values())
             outfile.write(''.join('{0}|{1}\n'.format(*l) for l in labels))
     elif args.action == 'update':
-        if token is None:
+        if client.token is None and not args.dry_run:
             raise RuntimeError('Updating labels requires a personal access token!')
-        print('Updating labels on {0}'.format(args.repository))
-        with open(args.filename, 'rt') as infile:
-            for line in infile:
-                parts = line.strip().split('|')
-                if len(parts) == 3:
-                    old_name, new_name, color = parts
-                else:
-                    new_name, color = parts
-                    old_name = new_name
-
-                try:
-                    label = repo.get_label(old_name)
-                    label.edit(new_name, color)
-                    print('Updated label: {0.name}->{1} (#{2})'.format(label, new_name, color))
-                except github.GithubException:
-                    label = repo.create_label(new_name, color)
-                    print('Created label: {0.name} (#{0.color})'.format(label))
+        wanted = read_labels(args.filename)
+        repo_names = resolve_repos(g, args.org, args.repository.split(','))
+
+        def update(repo_name):
+            try:
+                repo = client.thread_github().get_repo('{0}/{1}'.format(args.org, repo_name))
+                return sync_labels(repo, wanted, args.delete, args.dry_run) + (None,)
+            except github.GithubException as e:
+                return (), (), e
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(repo_names)))) as executor:
+            # Printed in order, a repository at a time, as the slowest so far finishes
+            for repo_name, (changes, failures, error) in zip(repo_names,
+                                                             executor.map(update, repo_names)):
+                print('Updating labels on {0}'.format(repo_name))
+                if error is not None:
+                    print('\tFailed: {0}'.format(error))
+                    failed.append(repo_name)
+                    continue
+                errors = dict(failures)
+                for change in changes:
+                    if change.action == 'unchanged':
+                        continue
+                    text = describe_change(change, args.dry_run)
+                    if change in errors:
+                        text = 'Failed: {0}: {1}'.format(text, errors[change])
+                    print('\t' + text)
+                print('\t' + summarize_changes(changes) +
+                      (', {0} failed'.format(len(failures)) if failures else ''))
+                if failures:
+                    failed.append(repo_name)
+
+        if len(repo_names) > 1:
+            print('{0} repositories, {1} failed{2}'.format(
+                len(repo_names), len(failed), ': ' + ', '.join(failed) if failed else ''))
+
+    client.close()
+    if args.action == 'update' and failed:
+        parser.exit(1)
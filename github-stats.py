@@ -1,24 +1,41 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from datetime import datetime, timedelta
-from functools import lru_cache
-from operator import itemgetter
+from bisect import bisect_right
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+import csv
+from datetime import datetime, timedelta, timezone
+from functools import partial, wraps
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+from itertools import chain, takewhile
+import json
+from operator import attrgetter, itemgetter
+import os
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
 import github
 
+from activity_store import ActivityStore, Comment, Fork, Issue, Star
+from github_client import add_arguments, Client, current_phase, request_phase
+from pagination import PrefetchedList
 
-# PyGitHub doesn't yet support the new watchers->subscribers API, so we borrow
-# some of their method code
-def get_subscribers(self):
-    """
-    :calls: `GET /repos/:owner/:repo/watchers <http://developer.github.com/v3/activity/starring>`_
-    :rtype: :class:`github.PaginatedList.PaginatedList` of :class:`github.NamedUser.NamedUser`
+
+def profiled(method):
+    r"""
+    Attribute the API requests made by a `RepoMetrics` method to it.
     """
-    return github.PaginatedList.PaginatedList(
-        github.NamedUser.NamedUser,
-        self._requester,
-        self.url + "/subscribers",
-        None
-    )
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with request_phase(method.__name__, self._repo.full_name):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Contributor(tuple):
@@ -68,14 +85,16 @@ class Contributor(tuple):
 
     @classmethod
     def _init_cache(cls):
-        cls._known_users = dict()
+        # Fill before publishing so other threads never see a partial cache
+        known_users = dict()
         try:
             with open('known_users', 'rt') as userfile:
                 for line in userfile:
                     login, affil, typ = line.rstrip().split(',')
-                    cls._known_users[login] = affil.strip(), typ.strip()
+                    known_users[login] = affil.strip(), typ.strip()
         except IOError:
             pass
+        cls._known_users = known_users
 
     def __str__(self):
         return u', '.join(self)
@@ -85,6 +104,231 @@ def filter_members(users, members):
     return set(users) - members
 
 
+def fetch_user_profiles(requester, logins):
+    r"""
+    Look up (name, email, company) for many users with a single GraphQL query.
+
+    Organizations (which often own forks) are looked up too, without a company. Logins that
+    do not resolve (e.g. deleted accounts or bots) get empty profiles.
+    """
+    query = '{{{0}}}'.format(' '.join(
+        'u{0}: repositoryOwner(login: {1}) {{ ... on User {{ name email company }} '
+        '... on Organization {{ name email }} }}'.format(n, json.dumps(login))
+        for n, login in enumerate(logins)))
+
+    # Not using graphql_query(), since it raises on the errors for logins not found
+    _, data = requester.requestJsonAndCheck('POST', '/graphql', input=dict(query=query))
+    results = data.get('data') or dict()
+    profiles = dict()
+    for n, login in enumerate(logins):
+        user = results.get('u{0}'.format(n))
+        profiles[login] = ((user.get('name'), user.get('email'), user.get('company')) if user
+                           else ('', '', ''))
+    return profiles
+
+
+class ContributorCache(object):
+    r"""
+    Profiles (name, email, company) of users by login, optionally kept in a JSON file.
+
+    Profiles older than `ttl` are considered stale and looked up again.
+    """
+    batch_size = 100
+
+    def __init__(self, path=None, ttl=timedelta(days=30)):
+        self.path = path
+        self.ttl = ttl
+        self._profiles = dict()
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path, 'rt') as cache_file:
+                    self._profiles = json.load(cache_file)
+            except (IOError, ValueError):
+                pass
+
+    def _fresh(self, entry):
+        return time.time() - entry[-1] < self.ttl.total_seconds()
+
+    def get(self, login):
+        entry = self._profiles.get(login)
+        if entry is None or not self._fresh(entry):
+            return None
+        return tuple(entry[:3])
+
+    def put(self, login, profile):
+        with self._lock:
+            self._profiles[login] = list(profile) + [time.time()]
+
+    def resolve(self, requester, logins):
+        r"""
+        Look up, in batches, the profiles of any of `logins` not already cached.
+        """
+        missing = sorted({login for login in logins if self.get(login) is None})
+        for i in range(0, len(missing), self.batch_size):
+            try:
+                profiles = fetch_user_profiles(requester, missing[i:i + self.batch_size])
+            # GraphQL needs a token; get_user will fall back to looking up users one at a time
+            except github.GithubException:
+                return
+            for login, profile in profiles.items():
+                self.put(login, profile)
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            profiles = {login: entry for login, entry in self._profiles.items()
+                        if self._fresh(entry)}
+        with tempfile.NamedTemporaryFile('wt', dir=os.path.dirname(os.path.abspath(self.path)),
+                                         suffix='.tmp', delete=False) as cache_file:
+            json.dump(profiles, cache_file)
+        os.replace(cache_file.name, self.path)
+
+
+class MemberIndex(object):
+    r"""
+    Logins of the members of organizations, optionally kept in a JSON file.
+
+    Member listings older than `ttl` are fetched again. Only logins are kept, so checking
+    membership never needs anyone's profile. Logins are not case-sensitive, so they are
+    given lowercased, to check those of other users lowercased against.
+    """
+    def __init__(self, path=None, ttl=timedelta(days=1)):
+        self.path = path
+        self.ttl = ttl
+        self._members = dict()
+        if path:
+            try:
+                with open(path, 'rt') as cache_file:
+                    self._members = json.load(cache_file)
+            except (IOError, ValueError):
+                pass
+
+    def members(self, name, org):
+        r"""
+        Get the lowercased logins of the members of organization `org` (called `name`).
+        """
+        entry = self._members.get(name)
+        if entry is None or time.time() - entry[0] >= self.ttl.total_seconds():
+            members = PrefetchedList(org._requester, org.url + '/members',
+                                     context=current_phase())
+            entry = [time.time(), sorted(m['login'] for m in members)]
+            self._members[name] = entry
+            self.save()
+        return frozenset(login.lower() for login in entry[1])
+
+    def save(self):
+        if not self.path:
+            return
+
+        with tempfile.NamedTemporaryFile('wt', dir=os.path.dirname(os.path.abspath(self.path)),
+                                         suffix='.tmp', delete=False) as cache_file:
+            json.dump(self._members, cache_file)
+        os.replace(cache_file.name, self.path)
+
+
+# Users outside the organization whose activity does not count as external
+default_internal_users = ['codecov-io', 'landscape-bot', 'rkambic', 'madry', 'BenDomenico',
+                          'JohnLCaron', 'russrew', 'donmurray', 'lago8103', 'mwilson14',
+                          'tjwixtrom', 'CLAassistant', 'codecov[bot]', 'haileyajohnson',
+                          'mgrover1', 'stickler-ci', 'jrleeman', 'zbruick', 'dependabot[bot]']
+
+
+def read_internal_users(path):
+    r"""
+    Read logins of internal users, one per line (``#`` starts a comment), if `path` exists.
+
+    Logins are lowercased, like those from `MemberIndex`.
+    """
+    try:
+        with open(path, 'rt') as userfile:
+            return [line.split('#', 1)[0].strip().lower() for line in userfile
+                    if line.split('#', 1)[0].strip()]
+    except IOError:
+        return [login.lower() for login in default_internal_users]
+
+
+def user_stub(requester, login):
+    r"""
+    Make a user for a login, completed from the API only when needed.
+    """
+    return github.NamedUser.NamedUser(requester, {}, dict(login=login, url='/users/' + login),
+                                      completed=False)
+
+
+def parse_date(text):
+    r"""
+    Parse a timestamp from the API as a naive UTC datetime.
+    """
+    return None if text is None else datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def to_iso(dt):
+    return utc(dt).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def round_down(dt, hours=24):
+    r"""
+    Round a time down to a multiple of `hours` hours into its day.
+
+    Times sent to the API are rounded, so that runs made soon after each other make the same
+    requests, which the response cache can revalidate.
+    """
+    dt = utc(dt)
+    return dt.replace(hour=dt.hour // hours * hours, minute=0, second=0, microsecond=0)
+
+
+def record_listing(repo, path, make_record, params=None, headers=None):
+    r"""
+    List the items at a path below a repository as compact records.
+
+    `make_record(data)` turns the JSON of each item into a record, so no PyGithub objects
+    (holding on to all of the JSON) are kept.
+    """
+    return github.PaginatedList.PaginatedList(
+        lambda requester, headers, data, **kwargs: make_record(data), repo._requester,
+        repo.url + path, params, headers=headers)
+
+
+def prefetched_listing(repo, path, make_record, params=None, headers=None):
+    r"""
+    List all items at a path below a repository as records, fetching pages concurrently.
+    """
+    return PrefetchedList(repo._requester, repo.url + path, params, headers, make_record,
+                          context=current_phase())
+
+
+# Limits of the search API: the longest query, and the most results it will page through
+max_search_length = 256
+max_search_results = 1000
+
+
+def search_total(requester, query):
+    r"""
+    Count the issues and PRs matching a search query, without listing them.
+    """
+    _, data = requester.requestJsonAndCheck('GET', '/search/issues',
+                                            parameters=dict(q=query, per_page=1))
+    return data['total_count']
+
+
+def search_listing(requester, query, make_record):
+    r"""
+    List the issues and PRs matching a search query as records.
+    """
+    return PrefetchedList(requester, '/search/issues', dict(q=query), make_item=make_record,
+                          context=current_phase(), key='items')
+
+
+def get_login(item):
+    try:
+        return item.user.login
+    except AttributeError:
+        return item.login
+
+
 def get_user(item):
     try:
         user = item.user
@@ -92,59 +336,59 @@ def get_user(item):
         user = item
 
     if user.login not in get_user.cache:
-        try:
-            get_user.cache[user.login] = Contributor(user.login, user.name, user.email,
-                                                     user.company)
-        # Apparently the API will give us forks for deleted accounts?
-        except github.UnknownObjectException:
-            get_user.cache[user.login] = Contributor(user.login, '', '', '')
+        profile = get_user.profiles.get(user.login)
+        if profile is None:
+            try:
+                profile = user.name, user.email, user.company
+            # Apparently the API will give us forks for deleted accounts?
+            except github.UnknownObjectException:
+                profile = '', '', ''
+            get_user.profiles.put(user.login, profile)
+        get_user.cache[user.login] = Contributor(user.login, *profile)
 
     return get_user.cache[user.login]
 
 
 get_user.cache = dict()
+get_user.profiles = ContributorCache()
 
 
-def get_external_participation(issues, members, date_check):
-    opened = dict()
-    comments = dict()
-    for i in issues:
-        user = get_user(i)
-        if user not in members and date_check(i.created_at):
-            opened.setdefault(user, []).append(i)
-        for c in i.get_comments():
-            user = get_user(c)
-            if user not in members and date_check(c.created_at):
-                comments.setdefault(user, []).append(c)
-    return opened, comments
-
-
-def get_support_effort(ext_issues):
-    return sum(i.comments for issues in ext_issues.values() for i in issues)
-
-
-def get_token():
+def group_comments_by_issue(comments):
     r"""
-    Get the API token to use for talking to GitHub
+    Group a stream of comment records by the number of their issue.
     """
-    try:
-        with open('token', 'rt') as token_file:
-            return token_file.readline()[:-1]
-    except IOError:
-        import os
-        return os.environ.get('GITHUB_TOKEN')
+    grouped = dict()
+    for c in comments:
+        grouped.setdefault(c.issue_number, []).append(c)
+    return grouped
 
 
-def created_count(issues, date_check):
-    return count_if(issues, lambda i: date_check(i.created_at))
+def get_external_participation(issues, members, date_check, issue_comments):
+    r"""
+    Collect issues opened and comments made by non-members, keyed by user.
 
+    `members` are lowercased logins, as from `MemberIndex`.
 
-def closed_count(issues, date_check):
-    return count_if(issues, lambda i: i.state == 'closed' and date_check(i.closed_at))
+    `issue_comments` are the comments grouped by issue number.
+    """
+    opened = dict()
+    comments = dict()
+    for i in issues:
+        if get_login(i).lower() not in members and date_check(i.created_at):
+            opened.setdefault(get_user(i), []).append(i)
+        for c in issue_comments.get(i.number, ()):
+            if get_login(c).lower() not in members and date_check(c.created_at):
+                comments.setdefault(get_user(c), []).append(c)
+    return opened, comments
 
 
-def count_if(seq, pred):
-    return sum(1 for item in seq if pred(item))
+def utc(dt):
+    r"""
+    Convert a datetime to naive UTC, since newer PyGithub returns timezone-aware datetimes
+    """
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
 
 
 # useful for generators without making the full list
@@ -158,58 +402,99 @@ def print_users(users):
         print(u'\t\t' + str(u))
 
 
-def count_total_items(dict_of_list):
-    return sum(len(item) for item in dict_of_list.values())
+IssueCounts = namedtuple('IssueCounts', 'active created closed')
+ExternalActivity = namedtuple('ExternalActivity', 'opened closed comments replies')
+MetricsSummary = namedtuple('MetricsSummary', 'name watchers total_watchers issues prs '
+                                              'ext_issues ext_prs contributors new_stars '
+                                              'total_stars new_forks total_forks commits events')
+SearchCounts = namedtuple('SearchCounts', 'created closed ext_opened ext_closed')
+CountSummary = namedtuple('CountSummary', 'name issues prs new_stars total_stars new_forks '
+                                          'total_forks total_watchers commits')
+BucketSummary = namedtuple('BucketSummary', 'start end issues prs ext_issues ext_prs '
+                                            'contributors new_stars new_forks')
+BucketedSummary = namedtuple('BucketedSummary', 'name buckets')
 
 
-def count_total_closed(dict_of_list, date_check):
-    return sum(closed_count(issues, date_check) for issues in dict_of_list.values())
+def bucket_starts(start, end, period):
+    r"""
+    Get the start times of the week, month or quarter buckets covering a time range.
+
+    The first bucket starts at `start` itself, so it may be partial, as may the last.
+    """
+    starts = [start]
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while True:
+        if period == 'week':
+            day = day + timedelta(days=7 - day.weekday())
+        else:
+            months = 3 if period == 'quarter' else 1
+            month = (day.month - 1) // months * months + months
+            day = day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+        if day >= end:
+            return starts
+        starts.append(day)
+
+
+def memoized(method):
+    r"""
+    Cache the result of a method on the instance.
+
+    Unlike `lru_cache`, this does not keep instances alive after they are done with.
+    """
+    name = '_memo_' + method.__name__
+
+    @wraps(method)
+    def wrapper(self):
+        if name not in self.__dict__:
+            self.__dict__[name] = method(self)
+        return self.__dict__[name]
+    return wrapper
 
 
 class RepoMetrics(object):
-    def __init__(self, repo, start, end, blacklist):
+    r"""
+    Activity of a repository from `start` to `end`, fetched as it is first needed.
+
+    Users in `blacklist`, as lowercased logins, are not counted as external. With a `store`,
+    activity is kept there and only what changed is fetched, unless `sync` is off, in which
+    case it is reported from the store as it is.
+    """
+    def __init__(self, repo, start, end, blacklist, bulk_comments=True, store=None,
+                 count_only=False, sync=True):
         self._repo = repo
         self._start = start
         self._end = end
         self._blacklist = blacklist
-        self._prs = self._issues = None
-        self.date_in_range = lambda d: self._start <= d <= self._end
+        self._bulk_comments = bulk_comments
+        self._store = store
+        self._count_only = count_only
+        self._sync = sync
+        self._users = dict()
+        self.date_in_range = lambda d: self._start <= utc(d) <= self._end
 
     @property
-    @lru_cache()
     def prs(self):
-        self._fetch_issues()
-        return self._prs
+        return self._fetch_issues()[1]
 
     @property
-    @lru_cache()
     def issues(self):
-        self._fetch_issues()
-        return self._issues
+        return self._fetch_issues()[0]
 
     @property
-    @lru_cache()
     def ext_issues(self):
-        self._fetch_external_issues()
-        return self._ext_issues
+        return self._fetch_external_issues()[0]
 
     @property
-    @lru_cache()
     def ext_issue_comments(self):
-        self._fetch_external_issues()
-        return self._ext_issue_comments
+        return self._fetch_external_issues()[1]
 
     @property
-    @lru_cache()
     def ext_prs(self):
-        self._fetch_external_prs()
-        return self._ext_prs
+        return self._fetch_external_prs()[0]
 
     @property
-    @lru_cache()
     def ext_pr_comments(self):
-        self._fetch_external_prs()
-        return self._ext_pr_comments
+        return self._fetch_external_prs()[1]
 
     @property
     def contributors(self):
@@ -222,157 +507,828 @@ class RepoMetrics(object):
 
     @property
     def total_stars(self):
-        return (s for s in self._fetch_stars() if get_user(s) not in self._blacklist)
+        return (s for s in self._fetch_stars() if self._external(s))
 
     @property
     def new_stars(self):
-        return (s for s in self.total_stars if self.date_in_range(s.starred_at))
+        return (s for s in self._fetch_new_stars()
+                if self.date_in_range(s.starred_at) and self._external(s))
 
     @property
     def watchers(self):
-        return (w for w in self._fetch_watchers() if get_user(w) not in self._blacklist)
+        return (w for w in self._fetch_watchers() if self._external(w))
 
     @property
     def total_forks(self):
-        return (f.owner for f in self._fetch_forks()
-                if get_user(f.owner) not in self._blacklist)
+        return (f.owner for f in self._external_forks())
 
     @property
     def new_forks(self):
-        def count_fork(f):
-            try:
-                return self.date_in_range(f.created_at)
-            except Exception:
-                return False
-        return (f for f in self.total_forks if count_fork(f))
+        return (f.owner for f in self._fetch_new_forks()
+                if self.date_in_range(f.created_at) and self._external(f.owner))
 
     @property
-    @lru_cache()
+    @memoized
+    @profiled
     def commits(self):
-        return self._repo.get_commits(since=self._start, until=self._end)
+        # Commits are counted, not filtered here, so their window is only rounded to the hour
+        return self._repo.get_commits(since=round_down(self._start, 1),
+                                      until=round_down(self._end, 1))
 
     @property
     def events(self):
-        for user, user_issues in self.ext_issues.items():
-            for i in user_issues:
-                yield (i.created_at, 'Issue', user)
-        for user, user_comments in self.ext_issue_comments.items():
-            for c in user_comments:
-                yield (c.created_at, 'Comment', user)
-        for user, user_issues in self.ext_prs.items():
-            for i in user_issues:
-                yield (i.created_at, 'PR', user)
-        for user, user_comments in self.ext_pr_comments.items():
-            for c in user_comments:
-                yield (c.created_at, 'PR Comment', user)
-        for star in self.new_stars:
-            yield (star.starred_at, 'Star', get_user(star.user))
-
-    @lru_cache()
-    def _fetch_forks(self):
-        return self._repo.get_forks()
+        r"""
+        Generate (time, kind, user) activity events in time order.
+
+        Each source is sorted on its own, whatever order it was listed in, and they are then
+        merged lazily. Users involved are looked up in batches first, as when summarizing.
+        """
+        self._resolve_users()
+        stars = ((s.starred_at, 'Star', get_user(s)) for s in self._fetch_new_stars()
+                 if self._external(s) and self.date_in_range(s.starred_at))
+        return heapq.merge(self._issue_events(self.issues, 'Issue'),
+                           self._comment_events(self.issues, 'Comment'),
+                           self._issue_events(self.prs, 'PR'),
+                           self._comment_events(self.prs, 'PR Comment'),
+                           sorted(stars, key=itemgetter(0)), key=itemgetter(0))
+
+    def _issue_events(self, issues, kind):
+        return sorted(((i.created_at, kind, get_user(i)) for i in issues
+                       if self._external(i) and self.date_in_range(i.created_at)),
+                      key=itemgetter(0))
+
+    def _comment_events(self, issues, kind):
+        grouped = self._fetch_comments()
+        return sorted(((c.created_at, kind, get_user(c)) for i in issues
+                       for c in grouped.get(i.number, ())
+                       if self._external(c) and self.date_in_range(c.created_at)),
+                      key=itemgetter(0))
+
+    @profiled
+    def summarize(self, events=True):
+        r"""
+        Collect everything used by the output formats into a `MetricsSummary`.
+
+        Each source is walked exactly once, and users are resolved and checked against the
+        blacklist once per item. The activity listing is only kept if `events` is set.
+        """
+        self._resolve_users()
+
+        def issue_counts(issues):
+            created = closed = 0
+            for i in issues:
+                created += self.date_in_range(i.created_at)
+                closed += i.state == 'closed' and self.date_in_range(i.closed_at)
+            return IssueCounts(len(issues), created, closed)
+
+        def external_activity(ext_issues, ext_comments):
+            opened = closed = replies = 0
+            for user_issues in ext_issues.values():
+                for i in user_issues:
+                    opened += 1
+                    closed += i.state == 'closed' and self.date_in_range(i.closed_at)
+                    replies += i.comments
+            comments = sum(len(user_comments) for user_comments in ext_comments.values())
+            return ExternalActivity(opened, closed, comments, replies)
+
+        new_stars = []
+        for s in self._fetch_new_stars():
+            if self._external(s) and self.date_in_range(s.starred_at):
+                new_stars.append(get_user(s))
+
+        new_forks = [get_user(f.owner) for f in self._fetch_new_forks()
+                     if self.date_in_range(f.created_at) and self._external(f.owner)]
+
+        if self._count_only:
+            watchers = ()
+            total_watchers, total_stars, total_forks = self._repo_totals()
+        else:
+            watchers = tuple(get_user(w) for w in self._fetch_watchers() if self._external(w))
+            total_watchers = len(watchers)
+            total_stars = count(self.total_stars)
+            total_forks = count(self.total_forks)
+
+        return MetricsSummary(
+            name=self.name, watchers=watchers, total_watchers=total_watchers,
+            issues=issue_counts(self.issues), prs=issue_counts(self.prs),
+            ext_issues=external_activity(self.ext_issues, self.ext_issue_comments),
+            ext_prs=external_activity(self.ext_prs, self.ext_pr_comments),
+            contributors=frozenset(self.contributors), new_stars=tuple(new_stars),
+            total_stars=total_stars, new_forks=tuple(new_forks), total_forks=total_forks,
+            commits=self._count_commits(), events=tuple(self.events) if events else ())
+
+    @profiled
+    def summarize_counts(self):
+        r"""
+        Count activity into a `CountSummary`, using the search API instead of listing issues.
+
+        Issues and PRs created and closed in the range are each counted from a single search.
+        No comments are fetched and no users are looked up.
+        """
+        total_watchers, total_stars, total_forks = self._repo_totals()
+        return CountSummary(
+            name=self.name, issues=self._search_counts('issue'), prs=self._search_counts('pr'),
+            new_stars=count(self.new_stars), total_stars=total_stars,
+            new_forks=count(self.new_forks), total_forks=total_forks,
+            total_watchers=total_watchers, commits=self._count_commits())
+
+    def _search_counts(self, kind):
+        r"""
+        Count the issues or PRs (`kind`) created and closed in the range into `SearchCounts`.
+
+        External ones are counted by excluding members with ``-author:`` qualifiers. When
+        there are too many members to fit in a query, the authors of those created in the
+        range are checked instead, and if there are more of those than search returns, they
+        come from the full listing.
+        """
+        requester = self._repo._requester
+        window = '{0}..{1}'.format(to_iso(self._start), to_iso(self._end))
+        created = 'repo:{0} is:{1} created:{2}'.format(self._repo.full_name, kind, window)
+        closed = 'closed:' + window
+        n_created = search_total(requester, created)
+        n_closed = search_total(requester, 'repo:{0} is:{1} {2}'.format(self._repo.full_name,
+                                                                         kind, closed))
+
+        external = ' '.join([created] + ['-author:' + login
+                                         for login in sorted(self._blacklist)])
+        if len(external) + len(closed) < max_search_length:
+            return SearchCounts(n_created, n_closed, search_total(requester, external),
+                                search_total(requester, external + ' ' + closed))
+
+        if n_created <= max_search_results:
+            opened = search_listing(requester, created, self._issue_record)
+        else:
+            opened = self.issues if kind == 'issue' else self.prs
+        ext_opened = ext_closed = 0
+        for i in opened:
+            if self._external(i) and self.date_in_range(i.created_at):
+                ext_opened += 1
+                ext_closed += i.state == 'closed' and self.date_in_range(i.closed_at)
+        return SearchCounts(n_created, n_closed, ext_opened, ext_closed)
+
+    @profiled
+    def summarize_buckets(self, starts):
+        r"""
+        Summarize activity in consecutive time buckets into a `BucketedSummary`.
+
+        `starts` are the sorted start times of the buckets, the last ending at the end of the
+        range. Everything is fetched once for the whole range, and each item is assigned to
+        its bucket by bisection. An issue or PR is active in the buckets it was created,
+        closed or last updated in.
+        """
+        self._resolve_users()
+        counts = [Counter() for _ in starts]
+        contributors = [set() for _ in starts]
+
+        def bucket(dt):
+            if dt is None or not self.date_in_range(dt):
+                return None
+            return bisect_right(starts, utc(dt)) - 1
+
+        def add(dt, key, n=1):
+            b = bucket(dt)
+            if b is not None:
+                counts[b][key] += n
+            return b
+
+        for kind, issues in (('issues', self.issues), ('prs', self.prs)):
+            for i in issues:
+                closed_at = i.closed_at if i.state == 'closed' else None
+                for b in {bucket(i.created_at), bucket(i.updated_at), bucket(closed_at)}:
+                    if b is not None:
+                        counts[b][kind, 'active'] += 1
+                add(i.created_at, (kind, 'created'))
+                add(closed_at, (kind, 'closed'))
+
+        for kind, ext_issues, ext_comments in (
+                ('ext_issues', self.ext_issues, self.ext_issue_comments),
+                ('ext_prs', self.ext_prs, self.ext_pr_comments)):
+            for user, user_issues in ext_issues.items():
+                for i in user_issues:
+                    b = add(i.created_at, (kind, 'opened'))
+                    add(i.created_at, (kind, 'replies'), i.comments)
+                    add(i.closed_at if i.state == 'closed' else None, (kind, 'closed'))
+                    if b is not None:
+                        contributors[b].add(user)
+            for user, user_comments in ext_comments.items():
+                for c in user_comments:
+                    b = add(c.created_at, (kind, 'comments'))
+                    if b is not None:
+                        contributors[b].add(user)
+
+        for s in self._fetch_new_stars():
+            if self._external(s):
+                add(s.starred_at, 'stars')
+        for f in self._fetch_new_forks():
+            if self._external(f.owner):
+                add(f.created_at, 'forks')
+
+        buckets = []
+        for b, (start, end) in enumerate(zip(starts, starts[1:] + [self._end])):
+            c = counts[b]
+            buckets.append(BucketSummary(
+                start=start, end=end,
+                issues=IssueCounts(*(c['issues', f] for f in IssueCounts._fields)),
+                prs=IssueCounts(*(c['prs', f] for f in IssueCounts._fields)),
+                ext_issues=ExternalActivity(*(c['ext_issues', f]
+                                              for f in ExternalActivity._fields)),
+                ext_prs=ExternalActivity(*(c['ext_prs', f] for f in ExternalActivity._fields)),
+                contributors=frozenset(contributors[b]), new_stars=c['stars'],
+                new_forks=c['forks']))
+        return BucketedSummary(self.name, tuple(buckets))
+
+    @profiled
+    def _count_commits(self):
+        return self.commits.totalCount
+
+    @profiled
+    def plan(self):
+        r"""
+        Estimate the API calls that `summarize` will make, by kind.
+
+        Sizes of listings not known from the repository itself are looked up with one call
+        each. Stars and forks are assumed to be spread evenly over the repository's lifetime.
+        """
+        per_page = self._repo._requester.per_page
+
+        def pages(n):
+            return max(1, -(-n // per_page))
+
+        lifetime = self._end - utc(self._repo.created_at)
+        window = min(1, (self._end - self._start).total_seconds() /
+                     max(lifetime.total_seconds(), 1))
+        new_stars = int(self._repo.stargazers_count * window)
+        new_forks = int(self._repo.forks_count * window)
+
+        calls = dict()
+        n_issues = self._repo.get_issues(state='all', since=self._start).totalCount
+        calls['issues'] = pages(n_issues)
+        if self._bulk_comments or self._store is not None:
+            n_comments = self._repo.get_issues_comments(since=self._start).totalCount
+            calls['comments'] = pages(n_comments)
+        else:
+            n_comments = 0
+            calls['comments'] = n_issues
+
+        # Reading stargazers backwards needs the link to the last page first; the recent ones
+        # come from the full listings when those are needed
+        calls['stars'] = 1 + pages(new_stars)
+        calls['forks'] = pages(new_forks)
+        calls['commits'] = 1
+        users = n_issues + n_comments + new_stars + new_forks
+        if not self._count_only:
+            calls['stars'] = pages(self._repo.stargazers_count)
+            calls['forks'] = pages(self._repo.forks_count)
+            calls['watchers'] = pages(self._repo.subscribers_count)
+            users += (self._repo.stargazers_count + self._repo.forks_count +
+                      self._repo.subscribers_count)
+        calls['users'] = -(-users // ContributorCache.batch_size)
+        return calls
+
+    def _repo_totals(self):
+        r"""
+        Get the totals of watchers, stars and forks without listing them in full.
+
+        These are the repository's own totals, less the members seen starring or forking
+        lately; stars and forks are local with the store, so those are counted exactly.
+        """
+        total_watchers = self._count_total(self._repo.subscribers_count, ())
+        if self._store is None:
+            total_stars = self._count_total(self._repo.stargazers_count,
+                                            self._fetch_new_stars())
+            total_forks = self._count_total(self._repo.forks_count,
+                                            (f.owner for f in self._fetch_new_forks()))
+        else:
+            total_stars = count(self.total_stars)
+            total_forks = count(self.total_forks)
+        return total_watchers, total_stars, total_forks
+
+    def _count_total(self, total, known):
+        r"""
+        Correct a repository total for the internal members known to be part of it.
+        """
+        return total - len({get_login(i) for i in known if not self._external(i)})
+
+    def _external(self, item):
+        return get_login(item).lower() not in self._blacklist
+
+    def _external_forks(self):
+        return (f for f in self._fetch_forks() if self._external(f.owner))
+
+    def _user_stub(self, login):
+        # One per login, shared by all of its records
+        if login not in self._users:
+            self._users[login] = user_stub(self._repo._requester, login)
+        return self._users[login]
+
+    def _record_user(self, data):
+        return self._user_stub(data['login'] if data else 'ghost')
+
+    def _issue_record(self, data):
+        return Issue(data['number'], self._record_user(data['user']), data['state'],
+                     parse_date(data['created_at']), parse_date(data['updated_at']),
+                     parse_date(data['closed_at']), data['comments'],
+                     bool(data.get('pull_request')))
+
+    def _comment_record(self, data):
+        return Comment(data['id'], int(data['issue_url'].rsplit('/', 1)[-1]),
+                       self._record_user(data['user']), parse_date(data['created_at']),
+                       parse_date(data['updated_at']))
 
+    def _star_record(self, data):
+        return Star(self._record_user(data['user']), parse_date(data['starred_at']))
+
+    def _fork_record(self, data):
+        return Fork(data['id'], self._record_user(data['owner']), parse_date(data['created_at']))
+
+    def _list_issues(self, since):
+        return prefetched_listing(self._repo, '/issues', self._issue_record,
+                                  dict(state='all', since=to_iso(round_down(since))))
+
+    def _list_comments(self, since):
+        return prefetched_listing(self._repo, '/issues/comments', self._comment_record,
+                                  dict(since=to_iso(round_down(since))))
+
+    def _list_stars(self, listing=prefetched_listing):
+        return listing(self._repo, '/stargazers', self._star_record,
+                       headers={'Accept': 'application/vnd.github.v3.star+json'})
+
+    @profiled
+    def _resolve_users(self):
+        r"""
+        Look up the profiles of everyone outside the organization involved with the repository.
+        """
+        items = chain(self._fetch_new_stars(), (f.owner for f in self._fetch_new_forks()),
+                      self.issues, self.prs,
+                      chain.from_iterable(self._fetch_comments().values()))
+        if not self._count_only:
+            items = chain(items, self._fetch_stars(), self._fetch_watchers(),
+                          (f.owner for f in self._fetch_forks()))
+        get_user.profiles.resolve(self._repo._requester,
+                                  {get_login(i) for i in items if self._external(i)})
+
+    def _forks_newest_first(self):
+        return record_listing(self._repo, '/forks', self._fork_record, dict(sort='newest'))
+
+    @memoized
+    @profiled
+    def _fetch_forks(self):
+        if self._store is None:
+            return list(prefetched_listing(self._repo, '/forks', self._fork_record,
+                                           dict(sort='oldest')))
+
+        # Newest first, so syncing can stop at the last fork already stored
+        name = self._repo.full_name
+        if self._sync:
+            self._store.sync_newest_first(name, 'forks', self._forks_newest_first(),
+                                          attrgetter('created_at'),
+                                          partial(self._store.store_forks, name))
+        return self._store.forks(name, self._user_stub)
+
+    @memoized
+    @profiled
+    def _fetch_new_forks(self):
+        """
+        Get forks created since the start time, without listing older ones unless all of
+        them are listed anyway
+        """
+        if self._store is None and self._count_only:
+            forks = self._forks_newest_first()
+        else:
+            forks = reversed(self._fetch_forks())
+        return list(takewhile(lambda f: utc(f.created_at) >= self._start, forks))[::-1]
+
+    @memoized
+    @profiled
     def _fetch_issues(self):
         """
-        Get issues and pull requests since a given time
+        Get issues and pull requests since a given time, as (issues, prs)
         """
+        if self._store is None:
+            issues = self._list_issues(self._start)
+        else:
+            name = self._repo.full_name
+            if self._sync:
+                self._store.sync_updated(name, 'issues', self._start, self._list_issues,
+                                         partial(self._store.store_issues, name))
+            issues = self._store.issues(name, self._start, self._end, self._user_stub)
+
         # Filter results to issues and PRs
-        self._issues = []
-        self._prs = []
-        for i in self._repo.get_issues(state='all', since=self._start):
+        plain_issues = []
+        prs = []
+        for i in issues:
             if (self.date_in_range(i.created_at) or self.date_in_range(i.updated_at) or
                     (i.state == 'closed' and self.date_in_range(i.closed_at))):
                 if i.pull_request:
-                    self._prs.append(i)
+                    prs.append(i)
                 else:
-                    self._issues.append(i)
+                    plain_issues.append(i)
+        return plain_issues, prs
 
-    @lru_cache()
+    @memoized
+    @profiled
     def _fetch_watchers(self):
-        return get_subscribers(self._repo)
+        return list(prefetched_listing(self._repo, '/subscribers', self._record_user))
 
-    @lru_cache()
+    @memoized
+    @profiled
     def _fetch_stars(self):
-        return self._repo.get_stargazers_with_dates()
-
+        if self._store is None:
+            return list(self._list_stars())
+
+        # Stargazers are listed oldest first, so sync from the last page backwards
+        name = self._repo.full_name
+        if self._sync:
+            self._store.sync_newest_first(name, 'stars',
+                                          self._list_stars(record_listing).reversed,
+                                          attrgetter('starred_at'),
+                                          partial(self._store.store_stars, name))
+        return self._store.stars(name, self._user_stub)
+
+    @memoized
+    @profiled
+    def _fetch_new_stars(self):
+        """
+        Get stargazers starred since the start time, without listing older ones unless all
+        of them are listed anyway
+        """
+        if self._store is None and self._count_only:
+            # Listed oldest first, so read from the last page backwards
+            stars = self._list_stars(record_listing).reversed
+        else:
+            stars = reversed(self._fetch_stars())
+        return list(takewhile(lambda s: utc(s.starred_at) >= self._start, stars))[::-1]
+
+    @memoized
+    @profiled
+    def _fetch_comments(self):
+        """
+        Get all issue and PR comments updated since the start time, grouped by issue number
+        """
+        if self._store is not None:
+            name = self._repo.full_name
+            if self._sync:
+                self._store.sync_updated(name, 'comments', self._start, self._list_comments,
+                                         partial(self._store.store_comments, name))
+            return group_comments_by_issue(self._store.comments(name, self._start,
+                                                                self._user_stub))
+
+        if not self._bulk_comments:
+            # Only issues with comments need a listing of their own
+            return {i.number: list(prefetched_listing(
+                        self._repo, '/issues/{0}/comments'.format(i.number),
+                        self._comment_record))
+                    for i in chain(self.issues, self.prs) if i.comments}
+        return group_comments_by_issue(self._list_comments(self._start))
+
+    @memoized
+    @profiled
     def _fetch_external_issues(self):
-        self._ext_issues, self._ext_issue_comments = get_external_participation(
-            self.issues, self._blacklist, self.date_in_range)
+        return get_external_participation(self.issues, self._blacklist, self.date_in_range,
+                                          self._fetch_comments())
 
+    @memoized
+    @profiled
     def _fetch_external_prs(self):
-        self._ext_prs, self._ext_pr_comments = get_external_participation(
-            self.prs, self._blacklist, self.date_in_range)
+        return get_external_participation(self.prs, self._blacklist, self.date_in_range,
+                                          self._fetch_comments())
 
 
-def output_default(metrics, verbose=0):
-    print('Repository: {0}'.format(metrics.name))
+class EventWriter(object):
+    r"""
+    Write (time, kind, user) activity events to a file as JSON lines or CSV.
+    """
+    fields = ('repo', 'date', 'kind', 'login', 'name', 'email', 'affiliation', 'type')
+
+    def __init__(self, outfile, fmt='ndjson'):
+        self._outfile = outfile
+        self._csv = None
+        if fmt == 'csv':
+            self._csv = csv.writer(outfile)
+            self._csv.writerow(self.fields)
 
-    print('\tWatchers: {0}'.format(count(metrics.watchers)))
+    def write(self, repo, events):
+        for dt, kind, user in events:
+            row = (repo, utc(dt).isoformat(), kind) + tuple(user)
+            if self._csv is not None:
+                self._csv.writerow(row)
+            else:
+                self._outfile.write(json.dumps(dict(zip(self.fields, row))) + '\n')
+
+
+def output_default(summary, verbose=0):
+    print('Repository: {0}'.format(summary.name))
+
+    print('\tWatchers: {0}'.format(summary.total_watchers))
     if verbose:
-        print_users(get_user(w) for w in metrics.watchers)
-
-    print('\tActive Issues: {0} ({1} created, {2} closed)'.format(
-        len(metrics.issues), created_count(metrics.issues, metrics.date_in_range),
-        closed_count(metrics.issues, metrics.date_in_range)))
-    print('\tActive PRs: {0} ({1} created, {2} closed)'.format(
-        len(metrics.prs), created_count(metrics.prs, metrics.date_in_range),
-        closed_count(metrics.prs, metrics.date_in_range)))
-    print('\tExternal Issue Activity: {0} opened, {1} comments'.format(
-        count_total_items(metrics.ext_issues),
-        count_total_items(metrics.ext_issue_comments)))
+        print_users(summary.watchers)
+
+    print('\tActive Issues: {0.active} ({0.created} created, {0.closed} closed)'.format(
+        summary.issues))
+    print('\tActive PRs: {0.active} ({0.created} created, {0.closed} closed)'.format(
+        summary.prs))
+    print('\tExternal Issue Activity: {0.opened} opened, {0.comments} comments'.format(
+        summary.ext_issues))
     if verbose:
-        print('\t\tTotal replies for created issues: {0}'.format(
-            get_support_effort(metrics.ext_issues)))
-    print('\tExternal PR Activity: {0} opened, {1} comments'.format(
-        count_total_items(metrics.ext_prs), count_total_items(metrics.ext_pr_comments)))
+        print('\t\tTotal replies for created issues: {0.replies}'.format(summary.ext_issues))
+    print('\tExternal PR Activity: {0.opened} opened, {0.comments} comments'.format(
+        summary.ext_prs))
     if verbose:
-        print('\t\tTotal replies for created PRs: {0}'.format(get_support_effort(metrics.ext_prs)))
-    print('\tUnique external contributors: {0}'.format(len(metrics.contributors)))
+        print('\t\tTotal replies for created PRs: {0.replies}'.format(summary.ext_prs))
+    print('\tUnique external contributors: {0}'.format(len(summary.contributors)))
 
-    print('\tStars: {0} ({1} total)'.format(count(metrics.new_stars),
-                                            count(metrics.total_stars)))
+    print('\tStars: {0} ({1} total)'.format(len(summary.new_stars), summary.total_stars))
     if verbose:
-        print_users(get_user(s) for s in metrics.new_stars)
+        print_users(summary.new_stars)
 
-    print('\tForks: {0} ({1} total)'.format(count(metrics.new_forks),
-                                            count(metrics.total_forks)))
+    print('\tForks: {0} ({1} total)'.format(len(summary.new_forks), summary.total_forks))
     if verbose:
-        print_users(get_user(f) for f in metrics.new_forks)
+        print_users(summary.new_forks)
 
-    print('\tCommits: {0}'.format(count(metrics.commits)))
+    print('\tCommits: {0}'.format(summary.commits))
 
-    print_users(metrics.contributors)
+    print_users(summary.contributors)
 
     if verbose >= 2:
         print('\tActivity Listing:')
-        for dt, kind, user in sorted(metrics.events):
+        for dt, kind, user in summary.events:
             print(u'\t\t{0}, {1}, {2}'.format(dt, kind, user))
 
 
-def nsf_output(metrics, *args):
-    print('Repository: {0}'.format(metrics.name))
-    print('\tExternal Issue Activity:\n\t\t{0} opened\n\t\t{1} closed\n\t\t{2} comments'.format(
-        count_total_items(metrics.ext_issues),
-        count_total_closed(metrics.ext_issues, metrics.date_in_range),
-        count_total_items(metrics.ext_issue_comments)))
-    print('\tExternal PR Activity:\n\t\t{0} opened\n\t\t{1} closed\n\t\t{2} comments'.format(
-        count_total_items(metrics.ext_prs),
-        count_total_closed(metrics.ext_prs, metrics.date_in_range),
-        count_total_items(metrics.ext_pr_comments)))
+def nsf_output(summary, *args):
+    print('Repository: {0}'.format(summary.name))
+    print('\tExternal Issue Activity:\n\t\t{0.opened} opened\n\t\t{0.closed} closed\n'
+          '\t\t{0.comments} comments'.format(summary.ext_issues))
+    print('\tExternal PR Activity:\n\t\t{0.opened} opened\n\t\t{0.closed} closed\n'
+          '\t\t{0.comments} comments'.format(summary.ext_prs))
+
+    print('\tUnique external contributors: {0}'.format(len(summary.contributors)))
+    print_users(summary.contributors)
+
+    print('\tStars: {0} ({1} total)'.format(len(summary.new_stars), summary.total_stars))
+    print_users(summary.new_stars)
 
-    print('\tUnique external contributors: {0}'.format(len(metrics.contributors)))
-    print_users(metrics.contributors)
+    print('\tWatchers: {0}'.format(summary.total_watchers))
+    print_users(summary.watchers)
 
-    print('\tStars: {0} ({1} total)'.format(count(metrics.new_stars),
-                                            count(metrics.total_stars)))
-    print_users(get_user(s) for s in metrics.new_stars)
+    print('\tForks: {0} ({1} total)'.format(len(summary.new_forks), summary.total_forks))
+    print_users(summary.new_forks)
 
-    print('\tWatchers: {0}'.format(count(metrics.watchers)))
-    print_users(get_user(w) for w in metrics.watchers)
 
-    print('\tForks: {0} ({1} total)'.format(count(metrics.new_forks),
-                                            count(metrics.total_forks)))
-    print_users(get_user(f) for f in metrics.new_forks)
+def output_summary(summary, *args):
+    print('Repository: {0}'.format(summary.name))
+    for title, counts in (('Issues', summary.issues), ('PRs', summary.prs)):
+        print('\t{0}: {1.created} created, {1.closed} closed'.format(title, counts))
+        print('\tExternal {0}: {1.ext_opened} opened, {1.ext_closed} closed'.format(title,
+                                                                                  counts))
+    print('\tStars: {0} ({1} total)'.format(summary.new_stars, summary.total_stars))
+    print('\tForks: {0} ({1} total)'.format(summary.new_forks, summary.total_forks))
+    print('\tWatchers: {0}'.format(summary.total_watchers))
+    print('\tCommits: {0}'.format(summary.commits))
+
+
+def output_buckets(summary, verbose=0):
+    print('Repository: {0}'.format(summary.name))
+    print('\t{0:<10} {1:>17} {2:>17} {3:>13} {4:>13} {5:>8} {6:>6} {7:>6}'.format(
+        'Start', 'Issues (new/cls)', 'PRs (new/cls)', 'Ext Issues', 'Ext PRs', 'Contrib',
+        'Stars', 'Forks'))
+    for b in summary.buckets:
+        print('\t{0:%Y-%m-%d} {1.active:>7} ({1.created:>3}/{1.closed:>3}) '
+              '{2.active:>7} ({2.created:>3}/{2.closed:>3}) {3.opened:>5} ({3.comments:>5}) '
+              '{4.opened:>5} ({4.comments:>5}) {5:>8} {6:>6} {7:>6}'.format(
+                  b.start, b.issues, b.prs, b.ext_issues, b.ext_prs, len(b.contributors),
+                  b.new_stars, b.new_forks))
+        if verbose:
+            print_users(b.contributors)
+
+
+formats = dict(default=output_default, nsf=nsf_output, summary=output_summary)
+
+
+def counts_only(formatter, verbose=0, exact_totals=False):
+    r"""
+    Whether totals can come from the repository itself, as they can unless users are printed.
+    """
+    return ((formatter is output_default and not verbose and not exact_totals) or
+            formatter in (output_buckets, output_summary))
+
+
+def summarize(metrics, formatter, verbose=0, starts=None):
+    r"""
+    Collect the summary of `metrics` that `formatter` prints, in buckets if given `starts`.
+    """
+    if starts is not None:
+        return metrics.summarize_buckets(starts)
+    if formatter is output_summary:
+        return metrics.summarize_counts()
+    return metrics.summarize(events=formatter is output_default and verbose >= 2)
+
+
+def to_json(value):
+    r"""
+    Convert a summary to plain JSON values; users become objects and times ISO 8601 text.
+    """
+    if isinstance(value, Contributor):
+        return dict(zip(EventWriter.fields[3:], value))
+    if isinstance(value, datetime):
+        return utc(value).isoformat()
+    if hasattr(value, '_asdict'):
+        return {key: to_json(item) for key, item in value._asdict().items()}
+    if isinstance(value, (set, frozenset)):
+        value = sorted(value)
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    return value
+
+
+# What a refresh of the service publishes: the activity kept from `start` to `refreshed`
+ServiceState = namedtuple('ServiceState', 'refreshed start blacklist snapshots seconds')
+RepoSnapshot = namedtuple('RepoSnapshot', 'repo watchers commits')
+
+
+class StoredMetrics(RepoMetrics):
+    r"""
+    `RepoMetrics` reported from the last refresh of a `StatsService`, without syncing.
+
+    Search counts come from the stored issues, and commits are counted once for each window
+    between refreshes, so only a window not asked for before makes an API call.
+    """
+    def __init__(self, service, state, snapshot, start, end, count_only=False):
+        # Bound to this thread's client, not the one the refresh made it with
+        repo = github.Repository.Repository(service.client.thread_github().requester, {},
+                                            snapshot.repo.raw_data, completed=True)
+        super(StoredMetrics, self).__init__(repo, start, end, state.blacklist,
+                                            store=service.store, count_only=count_only,
+                                            sync=False)
+        self._snapshot = snapshot
+
+    def _fetch_watchers(self):
+        return [self._user_stub(login) for login in self._snapshot.watchers]
+
+    def _count_commits(self):
+        window = self._start, self._end
+        if window not in self._snapshot.commits:
+            self._snapshot.commits[window] = super(StoredMetrics, self)._count_commits()
+        return self._snapshot.commits[window]
+
+    def _search_counts(self, kind):
+        created = closed = ext_opened = ext_closed = 0
+        for i in self.issues if kind == 'issue' else self.prs:
+            opened = self.date_in_range(i.created_at)
+            shut = i.state == 'closed' and self.date_in_range(i.closed_at)
+            created += opened
+            closed += shut
+            if opened and self._external(i):
+                ext_opened += 1
+                ext_closed += shut
+        return SearchCounts(created, closed, ext_opened, ext_closed)
+
+
+class StatsService(object):
+    r"""
+    Keep the activity of repositories in memory, refreshed on a schedule, to report on.
+
+    Activity for `history` before each refresh is kept in `store`, and a refresh only fetches
+    what changed since the last one, along with the repositories, their watchers and (as
+    often as `member_index` allows) the organization's members. Reports can then be made for
+    any window within what is kept, without going back to the API.
+    """
+    def __init__(self, client, org_name, repo_names, history, store, member_index,
+                 internal_users, exact_totals=False):
+        self.client = client
+        self.org_name = org_name
+        self.repo_names = repo_names
+        self.history = history
+        self.store = store
+        self.member_index = member_index
+        self.internal_users = frozenset(internal_users)
+        self.exact_totals = exact_totals
+        self.state = None
+        self._print_lock = threading.Lock()
+
+    def refresh(self):
+        r"""
+        Bring the members and activity up to date, then publish them for reports.
+        """
+        began = time.perf_counter()
+        now = datetime.utcnow()
+        start = now - self.history
+        org = self.client.thread_github().get_organization(self.org_name)
+        with request_phase('blacklist'):
+            blacklist = self.member_index.members(self.org_name, org) | self.internal_users
+
+        snapshots = dict()
+        for repo_name in self.repo_names:
+            repo = org.get_repo(repo_name)
+            metrics = RepoMetrics(repo, start, now, blacklist, store=self.store)
+            # Syncs every source on the way, so reports find everyone's profile cached
+            metrics._resolve_users()
+            snapshots[repo_name] = RepoSnapshot(
+                repo, tuple(get_login(w) for w in metrics._fetch_watchers()), dict())
+
+        # Published at once, so that no report mixes two refreshes
+        self.state = ServiceState(now, start, blacklist, snapshots,
+                                  time.perf_counter() - began)
+        get_user.profiles.save()
+
+    def run(self, interval):
+        r"""
+        Refresh every `interval` seconds, for as long as the process runs.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            # Reports keep using the last refresh until one succeeds
+            except Exception as e:
+                print('Refresh failed: {0}'.format(e), file=sys.stderr)
+
+    def status(self):
+        state = self.state
+        return dict(org=self.org_name, repositories=sorted(state.snapshots),
+                    refreshed=to_iso(state.refreshed), start=to_iso(state.start),
+                    refresh_seconds=round(state.seconds, 3))
+
+    def report(self, repo_name, start=None, end=None, days=None, fmt='default', bucket=None,
+               verbose=0):
+        r"""
+        Report on a repository from `start` (or `days` before `end`) to `end`.
+
+        The end defaults to, and is limited to, the last refresh. Returns the summary, as in
+        `to_json`, and the text `fmt` prints for it. Raises ValueError for a query that can
+        not be answered.
+        """
+        state = self.state
+        if repo_name not in state.snapshots:
+            raise ValueError('Unknown repository: {0}'.format(repo_name))
+        if fmt not in formats:
+            raise ValueError('Unknown format: {0}'.format(fmt))
+        if bucket not in (None, 'week', 'month', 'quarter'):
+            raise ValueError('Unknown bucket: {0}'.format(bucket))
+        end = min(end or state.refreshed, state.refreshed)
+        start = start or end - (timedelta(days=days) if days else self.history)
+        if start < state.start:
+            raise ValueError('Activity is only kept from {0}'.format(to_iso(state.start)))
+        if start >= end:
+            raise ValueError('Start must be before the end')
+
+        formatter = output_buckets if bucket else formats[fmt]
+        metrics = StoredMetrics(self, state, state.snapshots[repo_name], start, end,
+                                counts_only(formatter, verbose, self.exact_totals))
+        summary = summarize(metrics, formatter, verbose,
+                            bucket_starts(start, end, bucket) if bucket else None)
+        text = io.StringIO()
+        # Formatters print, and standard output is shared by every thread
+        with self._print_lock, redirect_stdout(text):
+            formatter(summary, verbose)
+        return dict(repo=repo_name, start=to_iso(start), end=to_iso(end),
+                    refreshed=to_iso(state.refreshed), summary=to_json(summary),
+                    report=text.getvalue())
+
+
+def parse_day(text):
+    return None if text is None else datetime.strptime(text, '%Y%m%d')
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    r"""
+    Answer ``GET /status``, and ``GET /report?repo=...`` with optional ``days``, or ``start``
+    and ``end`` [YYYYMMDD], and ``format``, ``bucket`` and ``verbose``, with JSON.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        service = self.server.service
+        if parts.path == '/status':
+            return self._send(200, service.status())
+        if parts.path != '/report':
+            return self._send(404, dict(message='Not Found'))
+
+        try:
+            report = service.report(params.get('repo'), parse_day(params.get('start')),
+                                    parse_day(params.get('end')),
+                                    int(params['days']) if 'days' in params else None,
+                                    params.get('format', 'default'), params.get('bucket'),
+                                    int(params.get('verbose', 0)))
+        except ValueError as e:
+            return self._send(400, dict(message=str(e)))
+        # Counting the commits of a new window is the only call made to the API
+        except github.GithubException as e:
+            return self._send(502, dict(message=str(e)))
+        self._send(200, report)
 
 
 if __name__ == '__main__':
@@ -386,7 +1342,8 @@ if __name__ == '__main__':
                                  'netCDF-Decoders', 'netCDF-Perl', 'idv',
                                  'LDM', 'awips2', 'gempak', 'rosetta',
                                  'UDUNITS-2', 'unidata-python-workshop'])
-    parser.add_argument('-f', '--format', help='Output format', type=str, default='default')
+    parser.add_argument('-f', '--format', help='Output format: default, nsf, or summary for '
+                        'counts only, from searches', type=str, default='default')
     parser.add_argument('-o', '--org', help='Organization', type=str, default='Unidata')
     parser.add_argument('-s', '--start', help='Starting date for stats [YYYYMMDD]', type=str)
     parser.add_argument('-e', '--end', help='Ending date for stats [YYYYMMDD]', type=str)
@@ -394,7 +1351,41 @@ if __name__ == '__main__':
                         default=90)
     parser.add_argument('-v', '--verbose', help='Verbose output', action='count',
                         default=0)
+    parser.add_argument('--comments', help='Fetch comments for the whole repository in one '
+                        'listing (bulk), or separately for each issue (per-issue)', type=str,
+                        choices=['bulk', 'per-issue'], default='bulk')
+    parser.add_argument('-j', '--jobs', help='Number of repositories to collect concurrently',
+                        type=int, default=1)
+    parser.add_argument('--store', help='SQLite file for keeping activity between runs, so '
+                        'that only changes since the last run are fetched', type=str)
+    parser.add_argument('--exact-totals', help='Count stars, forks and watchers from full '
+                        'listings, excluding all internal members; otherwise totals come from '
+                        'the repository unless users are listed', action='store_true')
     parser.add_argument('--debug', help='Print out debugging information', action='store_true')
+    parser.add_argument('--user-cache-ttl', help='Look up cached user profiles again after n '
+                        'days', type=int, default=30)
+    parser.add_argument('--member-cache-ttl', help='List organization members again after n '
+                        'hours', type=int, default=24)
+    parser.add_argument('--internal-users', help='File of other logins to exclude like '
+                        'members, one per line (default: a built-in list)', type=str,
+                        default='internal_users')
+    parser.add_argument('--page-workers', help='Number of pages of a listing to fetch at once',
+                        type=int, default=4)
+    parser.add_argument('--plan', help='Estimate the API calls needed instead of collecting '
+                        'stats', action='store_true')
+    parser.add_argument('--bucket', help='Report each week, month or quarter of the time range '
+                        'separately, from one fetch', type=str,
+                        choices=['week', 'month', 'quarter'])
+    parser.add_argument('--export', help='File to write the activity events of all repositories '
+                        'to, as they are collected', type=str)
+    parser.add_argument('--export-format', help='Format for --export (default from the file '
+                        'extension)', type=str, choices=['ndjson', 'csv'])
+    parser.add_argument('--serve', help='Instead of printing stats, keep the activity since the '
+                        'start in memory (or --store) and serve reports on it as JSON at this '
+                        'local port', type=int)
+    parser.add_argument('--refresh', help='With --serve, fetch what changed every n minutes',
+                        type=int, default=15)
+    add_arguments(parser)
     args = parser.parse_args()
 
     if args.start:
@@ -407,33 +1398,119 @@ if __name__ == '__main__':
     else:
         end = datetime.utcnow()
 
-    formats = dict(default=output_default, nsf=nsf_output)
     formatter = formats.get(args.format, output_default)
+    starts = None
+    if args.bucket:
+        starts = bucket_starts(start, end, args.bucket)
+        formatter = output_buckets
+
+    client = Client.from_args(args)
+    if not args.no_cache:
+        get_user.profiles = ContributorCache(os.path.join(args.cache_dir, 'users.json'),
+                                             ttl=timedelta(days=args.user_cache_ttl))
+        member_index = MemberIndex(os.path.join(args.cache_dir, 'members.json'),
+                                   ttl=timedelta(hours=args.member_cache_ttl))
+    else:
+        member_index = MemberIndex()
+    PrefetchedList.workers = args.page_workers
 
     # Get the github API entry
-    g = github.Github(get_token())
+    g = client.github()
 
     if args.debug:
-        rate = g.get_rate_limit().core
+        rate = g.get_rate_limit().resources.core
         print('API calls remaining: {0} (Resets at {1})'.format(rate.remaining, rate.reset))
 
     # Get the organization
     org = g.get_organization(args.org)
 
-    # Get blacklist of internal members so we can exclude from some stats
-    blacklist = {get_user(m) for m in org.get_members()}
+    store = ActivityStore(args.store) if args.store else None
+
+    count_only = counts_only(formatter, args.verbose, args.exact_totals)
+
+    def make_metrics(repo):
+        return RepoMetrics(repo, start, end, blacklist, bulk_comments=args.comments == 'bulk',
+                           store=store, count_only=count_only)
+
+    if args.plan:
+        print('Estimated API calls for {0} from {1} to {2}'.format(args.org, start, end))
+        blacklist = frozenset()
+        members = org.get_members().totalCount
+        total = 1 + -(-members // org._requester.per_page)
+        print('\tOrganization and blacklist: {0}'.format(total))
+        for repo_name in args.repository:
+            calls = make_metrics(org.get_repo(repo_name)).plan()
+            print('\t{0}: {1} ({2})'.format(repo_name, 1 + sum(calls.values()), ', '.join(
+                '{0} {1}'.format(kind, n) for kind, n in calls.items())))
+            total += 1 + sum(calls.values())
+        rate = g.get_rate_limit().resources.core
+        print('\tTotal: {0} ({1} remaining, resets at {2})'.format(total, rate.remaining,
+                                                                   rate.reset))
+        parser.exit()
+
+    if args.serve is not None:
+        # Refreshes only fetch what changed since the last, kept in memory without a file
+        service = StatsService(client, args.org, args.repository, datetime.utcnow() - start,
+                               store or ActivityStore(':memory:'), member_index,
+                               read_internal_users(args.internal_users), args.exact_totals)
+        service.refresh()
+        server = ThreadingHTTPServer(('127.0.0.1', args.serve), StatsHandler)
+        server.service = service
+        threading.Thread(target=service.run, args=(60 * args.refresh,), daemon=True).start()
+        print('Serving stats for {0} at http://127.0.0.1:{1}/report (refreshed in {2:.1f} s)'
+              .format(args.org, server.server_address[1], service.state.seconds), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        service.store.close()
+        get_user.profiles.save()
+        client.close(args.debug)
+        parser.exit()
 
-    # Add other users to blacklist
-    other_users = ['codecov-io', 'landscape-bot', 'rkambic', 'madry', 'BenDomenico',
-                   'JohnLCaron', 'russrew', 'donmurray', 'lago8103', 'mwilson14', 'tjwixtrom',
-                   'CLAassistant', 'codecov[bot]', 'haileyajohnson', 'mgrover1',
-                   'stickler-ci', 'jrleeman', 'zbruick', 'dependabot[bot]']
-    blacklist |= {get_user(g.get_user(u)) for u in other_users}
+    with request_phase('blacklist'):
+        # Logins of internal members and other users, to exclude from some stats
+        blacklist = (member_index.members(args.org, org) |
+                     frozenset(read_internal_users(args.internal_users)))
 
     # Release downloads?
 
+    def collect(repo_name):
+        repo = client.thread_github().get_repo('{0}/{1}'.format(args.org, repo_name))
+        metrics = make_metrics(repo)
+        return metrics, summarize(metrics, formatter, args.verbose, starts)
+
+    exporter = None
+    if args.export:
+        export_file = open(args.export, 'wt', newline='')
+        export_format = args.export_format or ('csv' if args.export.endswith('.csv')
+                                               else 'ndjson')
+        exporter = EventWriter(export_file, export_format)
+
+    def report(metrics, summary):
+        formatter(summary, args.verbose)
+        if exporter is not None:
+            # Written a repository at a time, so only one is ever held in memory
+            exporter.write(metrics.name, metrics.events)
+
     print('Stats for {0} from {1} to {2}'.format(args.org, start, end))
-    for repo_name in args.repository:
-        # Get the object for this repository
-        repo = org.get_repo(repo_name)
-        formatter(RepoMetrics(repo, start, end, blacklist), args.verbose)
+    if args.jobs > 1:
+        # Collect concurrently, but print in the requested order
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            for metrics, summary in executor.map(collect, args.repository):
+                report(metrics, summary)
+    else:
+        for repo_name in args.repository:
+            # Get the object for this repository
+            repo = org.get_repo(repo_name)
+            metrics = make_metrics(repo)
+            report(metrics, summarize(metrics, formatter, args.verbose, starts))
+
+    if exporter is not None:
+        export_file.close()
+
+    if store is not None:
+        store.close()
+
+    get_user.profiles.save()
+    client.close(args.debug)
@@ -0,0 +1,561 @@
+r"""
+Shared client for the scripts in this repository to talk to the GitHub API through.
+
+All requests go over one transport: keep-alive connections (one pool per thread) asking
+for gzip, an optional on-disk response cache revalidated with ETags, pacing and retries by
+the rate limit, and optional profiling of every request. `Client` makes the `github.Github`
+instances using it, and `add_arguments` adds the options for configuring it to a script.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import github
+import requests
+from urllib3.util.retry import Retry
+
+default_base_url = 'https://api.github.com'
+default_per_page = 100
+
+
+def get_base_url():
+    r"""
+    Get the URL of the GitHub API, which can be pointed elsewhere with GITHUB_API_URL
+    """
+    return os.environ.get('GITHUB_API_URL', default_base_url)
+
+
+def get_token():
+    r"""
+    Get the API token to use for talking to GitHub, or None to make anonymous requests.
+
+    The token is read from a ``token`` file in the working directory, then the GITHUB_TOKEN
+    or GH_TOKEN environment variables, and last from the GitHub CLI, if logged in.
+    """
+    try:
+        with open('token', 'rt') as token_file:
+            return token_file.readline().strip() or None
+    except IOError:
+        pass
+
+    for var in ('GITHUB_TOKEN', 'GH_TOKEN'):
+        if os.environ.get(var):
+            return os.environ[var]
+
+    # The CLI only knows about github.com
+    if get_base_url() != default_base_url:
+        return None
+    try:
+        proc = subprocess.run(['gh', 'auth', 'token'], capture_output=True, text=True,
+                              timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if proc.returncode:
+        return None
+    return proc.stdout.strip() or None
+
+
+class ResponseCache(object):
+    r"""
+    On-disk store of GET responses, keyed by URL (path and query string).
+
+    Entries are kept along with their ETag so that requests can be revalidated with
+    ``If-None-Match``; GitHub does not count a ``304 Not Modified`` against the rate limit.
+    Entries unused for longer than `max_age` are evicted, as are the least recently used
+    ones once the cache grows past `max_size` bytes.
+    """
+    def __init__(self, path, max_age=timedelta(days=30), max_size=500 * 1024 * 1024):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        fname = self._filename(key)
+        try:
+            with open(fname, 'rt') as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get('key') != key:
+            return None
+
+        # Mark as recently used for eviction
+        os.utime(fname, None)
+        return entry
+
+    def put(self, key, etag, headers, body):
+        with tempfile.NamedTemporaryFile('wt', dir=self.path, suffix='.tmp',
+                                         delete=False) as cache_file:
+            json.dump(dict(key=key, etag=etag, headers=headers, body=body), cache_file)
+        os.replace(cache_file.name, self._filename(key))
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def evict(self):
+        r"""
+        Remove expired entries, then the least recently used ones until under the size limit.
+        """
+        oldest = (datetime.now() - self.max_age).timestamp()
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.json'):
+                continue
+            stat = entry.stat()
+            if stat.st_mtime < oldest:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+
+class CachedResponse(object):
+    r"""
+    Mimic the httplib response object, replaying a cached body for a 304 response.
+    """
+    def __init__(self, entry, fresh_headers):
+        self.status = 200
+        self._headers = dict(entry['headers'])
+
+        # Take rate limit information and the like from the live response
+        self._headers.update((k.lower(), v) for k, v in fresh_headers)
+        self._body = entry['body']
+
+    def getheaders(self):
+        return self._headers.items()
+
+    def read(self):
+        return self._body
+
+
+class CachingConnectionMixin(object):
+    r"""
+    Revalidate GET requests against the `ResponseCache` set on the class.
+    """
+    cache = None
+
+    def getresponse(self):
+        if self.cache is None or self.verb != 'GET':
+            return super(CachingConnectionMixin, self).getresponse()
+
+        # Same URL can give different content depending on the media type requested
+        key = u'{0}{1}#{2}'.format(self.host, self.url, self.headers.get('Accept', ''))
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.headers = dict(self.headers)
+            self.headers['If-None-Match'] = entry['etag']
+
+        response = super(CachingConnectionMixin, self).getresponse()
+        if response.status == 304 and entry is not None:
+            self.cache.record(True)
+            return CachedResponse(entry, response.getheaders())
+
+        self.cache.record(False)
+        if response.status == 200:
+            headers = {k.lower(): v for k, v in response.getheaders()}
+            if 'etag' in headers:
+                self.cache.put(key, headers['etag'], headers, response.read())
+        return response
+
+
+class RateLimitScheduler(object):
+    r"""
+    Pace requests by the rate limit budget reported in response headers.
+
+    Budgets are tracked separately for each API resource (core, search, graphql). Once the
+    remaining budget drops to `reserve` (or a tenth of the limit, for small ones like search),
+    requests wait until the limit resets instead of failing. Secondary rate limit responses
+    are retried with exponential backoff. Writes from all threads are spaced at least
+    `write_interval` seconds apart, as GitHub asks of requests that change things.
+    """
+    def __init__(self, reserve=10, max_retries=5, backoff=30, write_interval=1):
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.write_interval = write_interval
+        self.waited = 0
+        self._next_write = 0
+        self._budgets = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def resource(url):
+        if url.startswith('/search/'):
+            return 'search'
+        if url.startswith('/graphql'):
+            return 'graphql'
+        return 'core'
+
+    def wait(self, resource, write=False):
+        r"""
+        Block until a request (a `write` or not) can be made against the budget for `resource`.
+        """
+        if write and self.write_interval:
+            with self._lock:
+                now = time.time()
+                delay = self._next_write - now
+                self._next_write = max(now, self._next_write) + self.write_interval
+            if delay > 0:
+                time.sleep(delay)
+
+        with self._lock:
+            remaining, limit, reset = self._budgets.get(resource, (None, None, None))
+            delay = reset - time.time() + 1 if remaining is not None else 0
+            if remaining is None or remaining > min(self.reserve, limit // 10) or delay <= 0:
+                return
+
+            # Only one thread needs to find out about the new budget
+            del self._budgets[resource]
+        self.pause(delay, 'until the {0} rate limit resets'.format(resource))
+
+    def pause(self, delay, reason='to retry a rate limited request'):
+        r"""
+        Sleep for `delay` seconds, saying so on stderr, since it can be up to an hour.
+        """
+        print('Waiting {0:.0f} s {1}'.format(delay, reason), file=sys.stderr, flush=True)
+        with self._lock:
+            self.waited += delay
+        time.sleep(delay)
+
+    def update(self, headers):
+        if 'x-ratelimit-remaining' not in headers:
+            return
+        with self._lock:
+            self._budgets[headers.get('x-ratelimit-resource', 'core')] = (
+                int(headers['x-ratelimit-remaining']),
+                int(headers.get('x-ratelimit-limit', headers['x-ratelimit-remaining'])),
+                int(headers['x-ratelimit-reset']))
+
+    def retry_delay(self, status, headers, body, attempt):
+        r"""
+        Get how long to wait before retrying a rate limited request, or None to not retry.
+        """
+        if status not in (403, 429) or attempt >= self.max_retries:
+            return None
+        if 'retry-after' in headers:
+            return int(headers['retry-after'])
+        if headers.get('x-ratelimit-remaining') == '0':
+            return max(int(headers['x-ratelimit-reset']) - time.time(), 0) + 1
+        if status == 429 or 'secondary rate limit' in body.lower():
+            return self.backoff * 2 ** attempt
+        return None
+
+
+class SchedulingConnectionMixin(object):
+    r"""
+    Make requests under the `RateLimitScheduler` set on the class.
+    """
+    scheduler = None
+
+    def getresponse(self):
+        if self.scheduler is None:
+            return super(SchedulingConnectionMixin, self).getresponse()
+
+        resource = self.scheduler.resource(self.url)
+        # GraphQL queries are POSTed, but only change anything as mutations, not used here
+        write = self.verb != 'GET' and resource != 'graphql'
+        attempt = 0
+        while True:
+            self.scheduler.wait(resource, write=write)
+            response = super(SchedulingConnectionMixin, self).getresponse()
+            headers = {k.lower(): v for k, v in response.getheaders()}
+            self.scheduler.update(headers)
+            body = response.read() if response.status == 403 else ''
+            delay = self.scheduler.retry_delay(response.status, headers, body, attempt)
+            if delay is None:
+                return response
+            self.scheduler.pause(delay)
+            attempt += 1
+
+
+_request_context = threading.local()
+
+
+@contextmanager
+def request_phase(phase, repo=None):
+    r"""
+    Attribute API requests made by this thread within the block to `phase` (and `repo`).
+    """
+    saved = getattr(_request_context, 'phase', None), getattr(_request_context, 'repo', None)
+    _request_context.phase = phase
+    if repo is not None:
+        _request_context.repo = repo
+    try:
+        yield
+    finally:
+        _request_context.phase, _request_context.repo = saved
+
+
+def current_phase():
+    r"""
+    Get a function making a `request_phase` block for the phase this thread is in.
+    """
+    phase = getattr(_request_context, 'phase', None)
+    repo = getattr(_request_context, 'repo', None)
+    return partial(request_phase, phase, repo)
+
+
+class RequestProfiler(object):
+    r"""
+    Record every API request along with the phase and repository that triggered it.
+    """
+    _id_patterns = [(re.compile(r'^/repos/[^/]+/[^/]+'), '/repos/:owner/:repo'),
+                    (re.compile(r'^/(users|orgs)/[^/]+'), r'/\1/:login'),
+                    (re.compile(r'/\d+(?=/|$)'), '/:number')]
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def template(cls, path):
+        for pattern, replacement in cls._id_patterns:
+            path = pattern.sub(replacement, path)
+        return path
+
+    def record(self, verb, url, status, latency, size, cache):
+        path, _, query = url.partition('?')
+        page = re.search(r'(?:^|&)page=(\d+)', query)
+        record = dict(phase=getattr(_request_context, 'phase', None) or 'setup',
+                      repo=getattr(_request_context, 'repo', None), verb=verb,
+                      url=self.template(path), page=int(page.group(1)) if page else 1,
+                      status=status, latency=latency, bytes=size, cache=cache)
+        with self._lock:
+            self.records.append(record)
+
+    def print_summary(self):
+        print('API requests by phase:')
+        print('\t{0:<24} {1:>8} {2:>8} {3:>10} {4:>10} {5:>12}'.format(
+            'Phase', 'Requests', 'Cached', 'Total [s]', 'Mean [ms]', 'Bytes'))
+        phases = dict()
+        for r in self.records:
+            phases.setdefault(r['phase'], []).append(r)
+        for phase, records in sorted(phases.items(), key=lambda p: -len(p[1])):
+            latency = sum(r['latency'] for r in records)
+            print('\t{0:<24} {1:>8} {2:>8} {3:>10.2f} {4:>10.1f} {5:>12}'.format(
+                phase, len(records), sum(r['cache'] == 'hit' for r in records), latency,
+                1000 * latency / len(records), sum(r['bytes'] for r in records)))
+
+    def write(self, path):
+        with open(path, 'wt') as outfile:
+            for r in self.records:
+                outfile.write(json.dumps(r) + '\n')
+
+
+class ProfilingConnectionMixin(object):
+    r"""
+    Report each request to the `RequestProfiler` set on the class.
+    """
+    profiler = None
+
+    def getresponse(self):
+        if self.profiler is None:
+            return super(ProfilingConnectionMixin, self).getresponse()
+
+        t0 = time.perf_counter()
+        response = super(ProfilingConnectionMixin, self).getresponse()
+        latency = time.perf_counter() - t0
+        if isinstance(response, CachedResponse):
+            cache = 'hit'
+        else:
+            cache = 'miss' if self.verb == 'GET' and CachingConnectionMixin.cache else '-'
+        self.profiler.record(self.verb, self.url, response.status, latency,
+                             len(response.read().encode('utf-8')), cache)
+        return response
+
+
+_sessions = threading.local()
+
+
+class PooledConnectionMixin(object):
+    r"""
+    Send requests over a keep-alive session shared by all connections made in a thread.
+
+    With connection classes injected, PyGithub makes a new connection for every request,
+    and each would otherwise open its own session, so no connection would be reused.
+    Requests that fail to connect, or get a server error, are retried with backoff here;
+    rate limited ones are left to `SchedulingConnectionMixin`.
+    """
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None,
+                 pool_size=None, **kwargs):
+        self.host = host
+        self.port = port if port else self.default_port
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+        self.session = self.shared_session(pool_size)
+
+    @classmethod
+    def shared_session(cls, pool_size=None):
+        r"""
+        Get the session for this thread, making it on first use.
+        """
+        session = getattr(_sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            # Not None, so that requests does not fall back to credentials in .netrc
+            session.auth = github.Requester.Requester.noopAuth
+            # requests decompresses these transparently
+            session.headers['Accept-Encoding'] = 'gzip'
+            pool_size = pool_size or requests.adapters.DEFAULT_POOLSIZE
+            adapter = requests.adapters.HTTPAdapter(max_retries=cls.retry,
+                                                    pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions.session = session
+        return session
+
+    def close(self):
+        # The session outlives the connection
+        pass
+
+
+class GithubHTTPConnection(SchedulingConnectionMixin, ProfilingConnectionMixin,
+                           CachingConnectionMixin, PooledConnectionMixin,
+                           github.Requester.HTTPRequestsConnectionClass):
+    protocol = 'http'
+    default_port = 80
+
+
+class GithubHTTPSConnection(SchedulingConnectionMixin, ProfilingConnectionMixin,
+                            CachingConnectionMixin, PooledConnectionMixin,
+                            github.Requester.HTTPSRequestsConnectionClass):
+    protocol = 'https'
+    default_port = 443
+
+
+def install_connection_layers(cache=None, scheduler=None, profiler=None):
+    r"""
+    Route all requests made by subsequently created `github.Github` instances through
+    `cache`, `scheduler` and `profiler`.
+    """
+    CachingConnectionMixin.cache = cache
+    SchedulingConnectionMixin.scheduler = scheduler
+    ProfilingConnectionMixin.profiler = profiler
+    github.Requester.Requester.injectConnectionClasses(GithubHTTPConnection,
+                                                       GithubHTTPSConnection)
+
+
+class Client(object):
+    r"""
+    Make `github.Github` instances that all share the transport set up here.
+
+    The instances are not safe to share between threads, so each thread should use its own,
+    from `thread_github()`; they are cheap, as connections are pooled regardless.
+    """
+    def __init__(self, token=None, per_page=default_per_page, cache=None, scheduler=None,
+                 profiler=None, profile_output=None, print_profile=False, request_interval=0):
+        self.token = token
+        self.per_page = per_page
+        self.request_interval = request_interval
+        self.cache = cache
+        self.scheduler = scheduler if scheduler is not None else RateLimitScheduler()
+        self.profiler = profiler
+        self.profile_output = profile_output
+        self.print_profile = print_profile
+        self._local = threading.local()
+        install_connection_layers(cache, self.scheduler, profiler)
+
+    @classmethod
+    def from_args(cls, args):
+        r"""
+        Make a client configured by the options from `add_arguments`.
+        """
+        cache = None
+        if not args.no_cache:
+            cache = ResponseCache(args.cache_dir, max_age=timedelta(days=args.cache_max_age),
+                                  max_size=args.cache_max_size * 1024 * 1024)
+        profiler = RequestProfiler() if args.profile or args.profile_output else None
+        return cls(get_token(), args.per_page, cache, RateLimitScheduler(args.rate_reserve),
+                   profiler, args.profile_output, args.profile, args.request_interval)
+
+    def github(self):
+        r"""
+        Make a new `github.Github`, authenticated if a token was found.
+        """
+        auth = github.Auth.Token(self.token) if self.token else None
+        # Retries, and the spacing of writes, are left to the connection layers
+        return github.Github(auth=auth, base_url=get_base_url(), per_page=self.per_page,
+                             retry=None, seconds_between_requests=self.request_interval,
+                             seconds_between_writes=0)
+
+    def thread_github(self):
+        r"""
+        Get the `github.Github` of the calling thread, made with `github()` on first use.
+        """
+        if not hasattr(self._local, 'github'):
+            self._local.github = self.github()
+        return self._local.github
+
+    def close(self, debug=False):
+        r"""
+        Trim the response cache and report on the requests made.
+        """
+        if self.cache is not None:
+            self.cache.evict()
+            if debug:
+                print('Response cache: {0} revalidated, {1} fetched'.format(self.cache.hits,
+                                                                           self.cache.misses))
+
+        if debug and self.scheduler.waited:
+            print('Waited {0:.0f}s for rate limits'.format(self.scheduler.waited))
+
+        if self.profiler is not None:
+            if self.print_profile:
+                self.profiler.print_summary()
+            if self.profile_output:
+                self.profiler.write(self.profile_output)
+
+
+def add_arguments(parser):
+    r"""
+    Add the options for configuring the `Client` to an `argparse.ArgumentParser`.
+    """
+    group = parser.add_argument_group('API client')
+    group.add_argument('--per-page', help='Number of items to request per page of a listing',
+                       type=int, default=default_per_page)
+    group.add_argument('--cache-dir', help='Directory for caching API responses', type=str,
+                       default=os.path.join(os.path.expanduser('~'), '.cache', 'github-utils'))
+    group.add_argument('--cache-max-age', help='Evict cached responses unused for n days',
+                       type=int, default=30)
+    group.add_argument('--cache-max-size', help='Maximum size of response cache [MB]', type=int,
+                       default=500)
+    group.add_argument('--no-cache', help='Do not cache API responses', action='store_true')
+    group.add_argument('--request-interval', help='Seconds to wait between the API requests of '
+                       'each thread; rate limits are kept to regardless', type=float, default=0)
+    group.add_argument('--rate-reserve', help='Wait for the rate limit to reset once only n '
+                       'API calls remain', type=int, default=10)
+    group.add_argument('--profile', help='Print a summary of API requests by phase',
+                       action='store_true')
+    group.add_argument('--profile-output', help='File to write each API request to, as JSON '
+                       'lines', type=str)
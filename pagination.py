@@ -0,0 +1,109 @@
+r"""
+Fetch paginated GitHub API listings with the pages after the first requested concurrently.
+
+PyGithub's `PaginatedList` requests one page at a time, following the ``next`` link of
+each, so a long listing costs a full round trip per page. GitHub also gives the ``last``
+page in the ``Link`` header though, so once the first page is in, all the others are known.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+import re
+import threading
+
+import github
+
+_last_link = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
+
+def last_page(link):
+    r"""
+    Get the number of the last page from a ``Link`` header, or 1 if there is only one page.
+    """
+    match = _last_link.search(link or '')
+    return int(match.group(1)) if match else 1
+
+
+class PrefetchedList(object):
+    r"""
+    Iterate over the items of a listing, requesting up to `workers` pages at once.
+
+    The first page is fetched on its own to find the number of pages; the rest are fetched
+    concurrently, but items are still yielded in order, and no more than `workers` pages are
+    held at a time. Pages are fetched by a pool of up to `threads` threads shared by every
+    listing, which lives as long as the process, so that the connections each thread keeps
+    are reused from one listing to the next. PyGithub requesters are not safe to share
+    between threads, so each thread makes its own, configured like `requester`.
+
+    `make_item(data)` makes each item from its JSON. For listings that wrap their items in
+    an object, like search results, `key` names the field holding them. If given,
+    `context()` makes a context manager that the worker threads make their requests within.
+    """
+    workers = 4
+    threads = 32
+
+    _pool = None
+    _pool_lock = threading.Lock()
+    _local = threading.local()
+
+    def __init__(self, requester, url, params=None, headers=None, make_item=None,
+                 context=None, key=None):
+        self._requester = requester
+        self._url = url
+        self._params = dict(params or (), per_page=requester.per_page)
+        self._headers = headers
+        self._make_item = make_item or (lambda data: data)
+        self._context = context or nullcontext
+        self._key = key
+
+    @classmethod
+    def executor(cls):
+        r"""
+        Get the pool of threads that pages are fetched by, starting it on first use.
+        """
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ThreadPoolExecutor(max_workers=cls.threads,
+                                               thread_name_prefix='page')
+            return cls._pool
+
+    def _fetch(self, requester, page):
+        params = dict(self._params, page=page) if page > 1 else self._params
+        headers, data = requester.requestJsonAndCheck('GET', self._url, parameters=params,
+                                                      headers=self._headers)
+        return headers, data[self._key] if self._key else data
+
+    def _fetch_page(self, page):
+        # Made again only when this thread moves on to a listing with another requester
+        local = self._local
+        if getattr(local, 'source', None) is not self._requester:
+            local.requester = github.Requester.Requester(**self._requester.kwargs)
+            local.source = self._requester
+        with self._context():
+            return self._fetch(local.requester, page)[1]
+
+    def __iter__(self):
+        headers, data = self._fetch(self._requester, 1)
+        for item in data:
+            yield self._make_item(item)
+
+        last = last_page(headers.get('link'))
+        if last == 1:
+            return
+
+        executor = self.executor()
+        pages = iter(range(2, last + 1))
+        pending = deque(executor.submit(self._fetch_page, page)
+                        for page in islice(pages, self.workers))
+        try:
+            while pending:
+                data = pending.popleft().result()
+                for page in islice(pages, 1):
+                    pending.append(executor.submit(self._fetch_page, page))
+                for item in data:
+                    yield self._make_item(item)
+        finally:
+            # Stopped early, so drop the pages not yet started
+            for future in pending:
+                future.cancel()
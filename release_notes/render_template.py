@@ -1,89 +1,206 @@
 #!/usr/bin/env python
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os
 import re
 import sys
+from urllib.parse import quote
 
-import github
 import jinja2
 
+# The shared client lives at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from github_client import add_arguments, Client  # noqa: E402
+from pagination import PrefetchedList  # noqa: E402
 
-def render(tpl_path, content):
+Release = namedtuple('Release', 'repo tag name body')
+
+formats = ['pyaos', 'python-users', 'roller']
+
+
+def make_environment(path, cache_dir=None):
+    """
+    Make the jinja environment for the templates in `path`, keeping compiled templates
+    in `cache_dir` between runs.
+    """
+    bytecode_cache = None
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(path or './'),
+                              bytecode_cache=bytecode_cache)
+
+
+class ReleaseNotes(object):
+    """
+    The named sections of the body of a release, split out in a single pass over its lines.
+
+    A section runs from its heading to the next heading of the same or a higher level, or
+    to another named section or a list of changes (Issues, New Features, ...), whichever is
+    first. Headings within a section are underlined instead, and markdown links are turned
+    to plain text in a copy of each line as it is read.
+    """
+    names = ('API Changes', 'Highlights', 'Summary')
+    stops = ('Issues', 'New Features', 'Enhancements', 'Bugs Fixed')
+
+    # Link text may hold one level of brackets, as in [`a[0]`](url)
+    _link = re.compile(r'\[((?:[^\[\]\n]|\[[^\[\]\n]*\])*)\]\(([^()\s]*)\)')
+
+    def __init__(self, body):
+        self._sections = dict()
+        current = None
+        level = 0
+        for line in body.splitlines():
+            stripped = line.strip()
+            depth = len(stripped) - len(stripped.lstrip('#'))
+            if not depth or not stripped[depth:depth + 1].isspace():
+                if current is not None:
+                    current[0].append(line)
+                    current[1].append(self._link.sub(r'\1 (\2)', line) if '](' in line
+                                      else line)
+                continue
+
+            title = stripped[depth:].strip()
+            name = next((n for n in self.names if n in title), None)
+            if name is not None or depth <= level or any(s in title for s in self.stops):
+                current = None
+            if name is not None and name not in self._sections:
+                current = self._sections[name] = ([], [])
+                level = depth
+            elif current is not None:
+                underline = '-' * len(title)
+                for lines in current:
+                    lines.extend((title, underline))
+
+    def __contains__(self, name):
+        return name in self._sections
+
+    def section(self, name, plain=False):
+        """
+        Get the text of a section, with links as plain text if `plain`, or '' if missing.
+        """
+        if name not in self._sections:
+            return ''
+        return '\n'.join(self._sections[name][plain]).strip()
+
+    def announcement(self, plain=False):
+        """
+        Get the API changes, then the highlights (or else the summary), for announcing.
+        """
+        summary = 'Highlights' if 'Highlights' in self else 'Summary'
+        if summary not in self:
+            raise RuntimeError('Unable to find summary in release notes.')
+        return self.section('API Changes', plain) + '\n' + self.section(summary, plain)
+
+
+def parse_target(target, default=None):
     """
-    Render the jinja template.
+    Split a ``repo[@release]`` argument into the repo and which of its releases to use.
+
+    The release is a tag, a range of tags ``first..last`` (either end may be left open), or
+    None for the latest release.
     """
-    path, filename = os.path.split(tpl_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(content)
+    repo_name, _, spec = target.partition('@')
+    return repo_name, spec or default
 
 
-def sub_header(match):
-    s = match.group(1).strip()
-    return s + '\n' + '-' * len(s)
+def make_release(repo_name, data):
+    return Release(repo_name, data['tag_name'], data['name'] or data['tag_name'],
+                   data['body'] or '')
 
 
-def strip_markdown_links(text):
+def fetch_releases(repo, spec=None):
     """
-    Turn any markdown links to plain text.
+    Get the releases of a repository picked out by `spec` (see `parse_target`).
     """
-    links = re.findall('\[.*\]\(.*\)', text)
-    links_cleaned = [l.replace('[','').replace(']', ' ') for l in links]
-    for link, clean in zip(links, links_cleaned):
-        text = text.replace(link, clean)
-    return text
+    requester = repo._requester
+    if spec is None:
+        return [make_release(repo.name, requester.requestJsonAndCheck(
+            'GET', repo.url + '/releases/latest')[1])]
+    if '..' not in spec:
+        return [make_release(repo.name, requester.requestJsonAndCheck(
+            'GET', '{0}/releases/tags/{1}'.format(repo.url, quote(spec)))[1])]
+
+    # Listed newest first
+    first, last = spec.split('..', 1)
+    releases = [make_release(repo.name, data)
+                for data in PrefetchedList(requester, repo.url + '/releases')
+                if not data['draft']]
+    tags = [r.tag for r in releases]
+    for tag in (first, last):
+        if tag and tag not in tags:
+            raise RuntimeError('Release {0} not found in {1}.'.format(tag, repo.name))
+    # Either way round, oldest first
+    ends = sorted([tags.index(last) if last else 0,
+                   tags.index(first) if first else len(tags) - 1])
+    return releases[ends[0]:ends[1] + 1][::-1]
+
+
+def render_release(template, release, outdir):
+    """
+    Render and write the announcements in every format for a release.
+    """
+    notes = ReleaseNotes(release.body)
+    for f in formats:
+        text = notes.announcement(plain=f != 'roller')
+        content = {'package_name': release.repo,
+                   'package_version': release.name,
+                   'release_notes': text,
+                   'format': f,
+                   'package_tag': 'python-siphon' if release.repo == 'siphon' else release.repo}
+        rendered_text = template.render(content)
+        with open(os.path.join(outdir, '{}.txt'.format(f)), 'w') as outfile:
+            outfile.write(rendered_text)
+            outfile.write('\n')
+
 
 if __name__ == '__main__':
     import argparse
 
     # Get command-line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('repository', help='Repository', type=str, nargs=1)
+    parser.add_argument('repository', help='Repositories, each optionally with @ and the '
+                        'release tag, or a range first..last of them', type=str, nargs='+')
     parser.add_argument('-o', '--org', help='Organization', type=str, default='Unidata')
-    parser.add_argument('-r', '--release', help='Release', type=str, default=None)
+    parser.add_argument('-r', '--release', help='Release, or range of releases, for '
+                        'repositories without one (default: the latest)', type=str,
+                        default=None)
+    parser.add_argument('-t', '--template', help='Template to render', type=str,
+                        default='templates/release_email.html')
+    parser.add_argument('-d', '--output-dir', help='Directory for the announcements; with more '
+                        'than one release, each gets a directory of its own within',
+                        type=str, default='formatted_notes')
+    parser.add_argument('-j', '--jobs', help='Number of repositories to fetch concurrently',
+                        type=int, default=8)
+    add_arguments(parser)
     args = parser.parse_args()
 
-    repo_name = args.repository[0]
-
-    # Get the repo's set of release notes
-    git = github.Github()
-    repo = git.get_repo('Unidata/{}'.format(repo_name))
-    if args.release is None:
-        latest = repo.get_latest_release()
-    else:
-        latest = repo.get_release(args.release)
-
-    # Clean up the notes
-    find_api_changes = re.compile(r'.*(?:API Changes)(.*?)[# ]*(?:Highlights|Summary)', re.MULTILINE|re.DOTALL)
-    api_changes = find_api_changes.findall(latest.body)
-    if api_changes:
-        api_changes = api_changes[0].strip().rstrip()
-    find_notes = re.compile(r'.*(?:Highlights|Summary)(.*?)[# ]*(?:Issues|New Features|Enhancements|Bugs Fixed)',
-                            re.MULTILINE|re.DOTALL)
-    summary_notes = find_notes.findall(latest.body)
-    if not summary_notes:
-        raise RuntimeError('Unable to find summary in release notes.')
-    summary_notes = summary_notes[0].strip().rstrip()
-    header_replace = re.compile(r'#+ (.+)')
-    if api_changes:
-        api_changes = header_replace.sub(sub_header, api_changes).replace('\r\n', '\n')
-    else:
-        api_changes = ''
-    notes = header_replace.sub(sub_header, summary_notes).replace('\r\n', '\n')
-
-    # Make a set of release announcements
-    formats = ['pyaos', 'python-users', 'roller']
-    for f in formats:
-        if f != 'roller':
-            text = strip_markdown_links(api_changes + '\n' + notes)
-        else:
-            text = api_changes + '\n' + notes
-        content = {'package_name': repo_name,
-                   'package_version': latest.title,
-                   'release_notes': text,
-                   'format': f,
-                   'package_tag': 'python-siphon' if repo_name == 'siphon' else repo_name}
-        rendered_text = render('templates/release_email.html', content)
-        with open('formatted_notes/{}.txt'.format(f), 'w') as outfile:
-            outfile.write(rendered_text)
-            outfile.write('\n')
+    client = Client.from_args(args)
+    cache_dir = None if args.no_cache else os.path.join(args.cache_dir, 'jinja')
+    path, filename = os.path.split(args.template)
+    template = make_environment(path, cache_dir).get_template(filename)
+
+    def fetch(target):
+        repo_name, spec = parse_target(target, args.release)
+        repo = client.thread_github().get_repo('{0}/{1}'.format(args.org, repo_name))
+        return fetch_releases(repo, spec)
+
+    # Get the repos' sets of release notes
+    jobs = max(1, min(args.jobs, len(args.repository)))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        releases = [r for repo_releases in executor.map(fetch, args.repository)
+                    for r in repo_releases]
+
+    # Make a set of release announcements for each
+    for release in releases:
+        outdir = args.output_dir
+        if len(releases) > 1:
+            outdir = os.path.join(outdir, '{0}-{1}'.format(release.repo, release.tag))
+            print('{0} {1}: {2}'.format(release.repo, release.tag, outdir))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        render_release(template, release, outdir)
+
+    client.close()